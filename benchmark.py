@@ -0,0 +1,519 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#======================================================================
+#
+# benchmark.py - translator.py 性能测试
+#
+# 用法：
+#
+#     benchmark.py startup [--repeat=N] [--budget=毫秒]
+#                          [--engines=bing,baidu] [--text=hello]
+#     benchmark.py offline [--requests=N] [--jobs=N] [--engines=...]
+#                          [--latency=毫秒] [--jitter=毫秒] [--errors=比例]
+#     benchmark.py mock [--port=N] [--latency=毫秒] [--jitter=毫秒]
+#                       [--errors=比例]
+#
+# startup：在子进程里测量 import translator 的耗时、无参数启动耗时，
+# 以及各引擎从启动进程到输出第一个字节的时间（需要网络和密钥）。
+# 超出 --budget 或者模块导入时加载了重量级依赖时返回非零，
+# 可以放在提交前检查里防止启动时间退化。
+#
+# offline：启动本地的必应、百度、腾讯模拟服务，不访问真实接口，
+# 测量单次查询的延迟分位数、all 并发查询和批量翻译的吞吐量，
+# 以及配置加载、签名、HTTP、解析、输出各阶段的耗时。
+#
+# mock：只启动模拟服务并打印对应的 config.ini，方便手工测试。
+#
+#======================================================================
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import time
+import subprocess
+
+
+#----------------------------------------------------------------------
+# 常量
+#----------------------------------------------------------------------
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, 'translator.py')
+
+# 这些依赖只能在对应引擎首次创建时才加载
+HEAVY_MODULES = ('tencentcloud', 'requests', 'urllib3', 'socketserver')
+
+IMPORT_PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import translator
+t = time.perf_counter() - t
+heavy = sorted(set(n.split('.')[0] for n in sys.modules
+        if n.split('.')[0] in %r))
+print(json.dumps({'time': t, 'heavy': heavy}))
+''' % (HEAVY_MODULES,)
+
+
+#----------------------------------------------------------------------
+# 工具函数
+#----------------------------------------------------------------------
+def getopt (argv):
+    args = []
+    options = {}
+    for arg in argv:
+        if arg.startswith('-') and arg != '-':
+            key, _, val = arg.lstrip('-').partition('=')
+            options[key.strip()] = val.strip()
+        else:
+            args.append(arg)
+    return options, args
+
+
+def percentile (samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = int(round((len(samples) - 1) * p / 100.0))
+    return samples[index]
+
+
+def summary (samples):
+    return 'min %.1fms  p50 %.1fms  max %.1fms' % (
+            min(samples) * 1000, percentile(samples, 50) * 1000,
+            max(samples) * 1000)
+
+
+#----------------------------------------------------------------------
+# 启动时间
+#----------------------------------------------------------------------
+def measure_import (repeat):
+    import json
+    samples = []
+    heavy = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE],
+                cwd = HERE)
+        data = json.loads(output.decode('utf-8'))
+        samples.append(data['time'])
+        heavy = data['heavy']
+    return samples, heavy
+
+
+def measure_usage (repeat):
+    samples = []
+    with open(os.devnull, 'wb') as null:
+        for i in range(repeat):
+            t = time.perf_counter()
+            subprocess.call([sys.executable, SCRIPT], stdout = null)
+            samples.append(time.perf_counter() - t)
+    return samples
+
+
+# 从启动进程到 stdout 出现第一个字节的时间
+def measure_first_byte (engine, text, repeat):
+    samples = []
+    for i in range(repeat):
+        argv = [sys.executable, SCRIPT, '--engine=' + engine, '--no-cache', text]
+        t = time.perf_counter()
+        p = subprocess.Popen(argv, stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE)
+        first = p.stdout.read(1)
+        ttfb = time.perf_counter() - t
+        p.communicate()
+        if not first:
+            return None
+        samples.append(ttfb)
+    return samples
+
+
+def bench_startup (options):
+    repeat = int(options.get('repeat', 10))
+    budget = float(options.get('budget', 0))
+    engines = [ n for n in options.get('engines', '').split(',') if n ]
+    text = options.get('text', 'hello')
+    failed = False
+    samples, heavy = measure_import(repeat)
+    print('import translator:   ' + summary(samples))
+    if heavy:
+        print('  heavy modules loaded at import: ' + ', '.join(heavy))
+        failed = True
+    if budget > 0 and min(samples) * 1000 > budget:
+        print('  over budget: %.1fms > %.1fms' % (min(samples) * 1000, budget))
+        failed = True
+    print('translator.py usage: ' + summary(measure_usage(repeat)))
+    for engine in engines:
+        samples = measure_first_byte(engine, text, max(1, repeat // 5))
+        if samples is None:
+            print('%-20s no output' % (engine + ':'))
+            failed = True
+            continue
+        print('%-20s %s' % (engine + ' first byte:', summary(samples)))
+    return failed and 1 or 0
+
+
+#----------------------------------------------------------------------
+# 模拟服务：必应 SerpHoverTrans、百度通用翻译、腾讯云 TMT
+#----------------------------------------------------------------------
+BING_HEAD = (
+    '<!DOCTYPE html><html><head><meta charset="utf-8"/></head><body>'
+    '<div class="ht_content"><h4>%s</h4>'
+    '<span class="ht_attr" lang="en">[həˈləʊ] </span>'
+    '<ul>'
+    '<li><span class="ht_pos">int.</span>'
+    '<span class="ht_trs">你好；喂</span></li>'
+    '<li><span class="ht_pos">n.</span>'
+    '<span class="ht_trs">招呼；问候</span></li>'
+    '<li><span class="ht_pos">网络</span>'
+    '<span class="ht_trs">哈喽；哈罗</span></li>'
+    '</ul></div>')
+
+# 真实页面在释义之后还有大段脚本和统计代码
+BING_TAIL = ('<script type="text/javascript">' + 'var _w=window;' * 2000 +
+        '</script></body></html>')
+
+
+class MockSettings (object):
+
+    def __init__ (self, latency = 0.05, jitter = 0.02, errors = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+
+    def delay (self):
+        import random
+        wait = self.latency + random.uniform(-self.jitter, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def failed (self):
+        import random
+        return self.errors > 0 and random.random() < self.errors
+
+
+def make_mock_server (settings, port = 0):
+    import json
+    import uuid
+    try:
+        import socketserver
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from urllib.parse import urlparse, parse_qs
+    except ImportError:
+        import SocketServer as socketserver    # noqa: F821
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from urlparse import urlparse, parse_qs
+
+    class MockHandler (BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message (self, *args):
+            pass
+
+        def reply (self, code, body, ctype):
+            data = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body (self):
+            size = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(size).decode('utf-8')
+
+        def do_GET (self):
+            url = urlparse(self.path)
+            if url.path != '/dict/SerpHoverTrans':
+                return self.reply(404, 'not found', 'text/plain')
+            settings.delay()
+            if settings.failed():
+                return self.reply(503, 'busy', 'text/plain')
+            word = parse_qs(url.query).get('q', [''])[0]
+            html = BING_HEAD % word + BING_TAIL
+            self.reply(200, html, 'text/html; charset=utf-8')
+
+        def do_POST (self):
+            body = self.read_body()
+            settings.delay()
+            if self.path.startswith('/api/trans/vip/translate'):
+                return self.baidu(parse_qs(body))
+            return self.tmt(json.loads(body or '{}'))
+
+        def baidu (self, form):
+            if settings.failed():
+                resp = {'error_code': '54003', 'error_msg': 'Invalid Access Limit'}
+            else:
+                lines = form.get('q', [''])[0].split('\n')
+                resp = {'from': form.get('from', ['en'])[0],
+                        'to': form.get('to', ['zh'])[0],
+                        'trans_result': [ {'src': n, 'dst': '[baidu] ' + n}
+                            for n in lines ]}
+            self.reply(200, json.dumps(resp), 'application/json')
+
+        def tmt (self, params):
+            action = self.headers.get('X-TC-Action', '')
+            resp = {'RequestId': str(uuid.uuid4())}
+            if settings.failed():
+                resp['Error'] = {'Code': 'RequestLimitExceeded',
+                        'Message': 'request limit exceeded'}
+            elif action == 'TextTranslateBatch':
+                resp['TargetTextList'] = [ '[tecent] ' + n
+                        for n in params.get('SourceTextList', []) ]
+                resp['Source'] = params.get('Source', 'en')
+                resp['Target'] = params.get('Target', 'zh')
+            else:
+                resp['TargetText'] = '[tecent] ' + params.get('SourceText', '')
+                resp['Source'] = params.get('Source', 'en')
+                resp['Target'] = params.get('Target', 'zh')
+            body = json.dumps({'Response': resp})
+            self.reply(200, body, 'application/json')
+
+    class MockServer (socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    return MockServer(('127.0.0.1', port), MockHandler)
+
+
+def start_mock_server (settings, port = 0):
+    import threading
+    server = make_mock_server(settings, port)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def mock_config (port):
+    base = 'http://127.0.0.1:%d' % port
+    lines = [
+        '[default]',
+        'cache = no',
+        'timeout = 5',
+        'backoff = 0.05',
+        'pool_size = 16',
+        '',
+        '[bingdict]',
+        'url = %s/dict/SerpHoverTrans' % base,
+        '',
+        '[baidu]',
+        'apikey = benchmark',
+        'secret = benchmark',
+        'url = %s/api/trans/vip/translate' % base,
+        '',
+        '[tecent]',
+        'secretid = benchmark',
+        'secretkey = benchmark',
+        'endpoint = 127.0.0.1:%d' % port,
+        'scheme = http',
+        '',
+    ]
+    return '\n'.join(lines)
+
+
+# 把 HOME 指向临时目录，让 translator 读取指向模拟服务的配置
+def setup_home (port):
+    import tempfile
+    home = tempfile.mkdtemp(prefix = 'translator-bench-')
+    path = os.path.join(home, '.config', 'translator')
+    os.makedirs(path)
+    with open(os.path.join(path, 'config.ini'), 'w') as fp:
+        fp.write(mock_config(port))
+    os.environ['HOME'] = home
+    os.environ['USERPROFILE'] = home
+    return home
+
+
+def mock_settings (options):
+    latency = float(options.get('latency', 50)) / 1000.0
+    jitter = float(options.get('jitter', 20)) / 1000.0
+    errors = float(options.get('errors', 0))
+    return MockSettings(latency, jitter, errors)
+
+
+def bench_mock (options):
+    port = int(options.get('port', 8757))
+    server = make_mock_server(mock_settings(options), port)
+    print('# mock server on 127.0.0.1:%d, config.ini:' % port)
+    print(mock_config(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+#----------------------------------------------------------------------
+# 离线测试
+#----------------------------------------------------------------------
+def report (name, samples):
+    if not samples:
+        print('%-24s no samples' % name)
+        return
+    print('%-24s n=%-5d p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  max %7.1fms' % (
+        name, len(samples), percentile(samples, 50) * 1000,
+        percentile(samples, 90) * 1000, percentile(samples, 99) * 1000,
+        max(samples) * 1000))
+
+
+# 单次调用的平均耗时（秒）
+def timeit (func, count = 1000):
+    t = time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter() - t) / count
+
+
+def load_engines (translator, names):
+    engines = {}
+    for name in names:
+        try:
+            engines[name] = translator.get_translator(name)
+        except ImportError as e:
+            print('%-24s skipped: %s' % (name, e))
+    return engines
+
+
+def bench_latency (engines, count):
+    print('\n== lookup latency (cache off) ==')
+    failures = 0
+    for name, engine in engines.items():
+        samples = []
+        for i in range(count):
+            t = time.perf_counter()
+            try:
+                engine.lookup('auto', 'auto', 'hello %d' % i, False)
+            except Exception:
+                failures += 1
+                continue
+            samples.append(time.perf_counter() - t)
+        report(name, samples)
+    if failures:
+        print('failures: %d' % failures)
+
+
+def bench_fanout (translator, names, count):
+    print('\n== all fan-out ==')
+    samples = []
+    statuses = {}
+    t = time.perf_counter()
+    for i in range(count):
+        start = time.perf_counter()
+        outcomes = translator.dispatch(names, 'auto', 'auto', 'hello %d' % i,
+                {'no-cache': ''}, 10)
+        samples.append(time.perf_counter() - start)
+        for outcome in outcomes:
+            statuses[outcome.status] = statuses.get(outcome.status, 0) + 1
+    elapsed = time.perf_counter() - t
+    report('all', samples)
+    print('throughput: %.1f lookups/s  outcomes: %r' % (count / elapsed, statuses))
+
+
+class NullWriter (object):
+
+    def __init__ (self):
+        self.lines = 0
+
+    def write (self, text):
+        self.lines += text.count('\n')
+
+    def flush (self):
+        pass
+
+
+def bench_batch (translator, engines, count, jobs):
+    print('\n== batch (jobs=%d) ==' % jobs)
+    for name, engine in engines.items():
+        segments = ( 'line %d of the corpus' % i for i in range(count) )
+        writer = NullWriter()
+        t = time.perf_counter()
+        translator.batch_translate(engine, 'auto', 'auto', segments,
+                {'no-cache': ''}, writer, jobs)
+        elapsed = time.perf_counter() - t
+        print('%-24s %d lines in %.2fs  %.1f lines/s' % (name, writer.lines,
+            elapsed, writer.lines / elapsed))
+
+
+def bench_stages (translator, engines, port):
+    import io
+    import json
+    print('\n== stages (per call) ==')
+    store = translator.get_config_store()
+    filename = translator.config_path('config.ini')
+    cost = timeit(lambda: store._load_ini(filename), 200)
+    print('%-24s %8.1fus' % ('config load', cost * 1e6))
+    cost = timeit(lambda: store.get('baidu'), 10000)
+    print('%-24s %8.1fus' % ('config view', cost * 1e6))
+    if 'baidu' in engines:
+        baidu = engines['baidu']
+        cost = timeit(lambda: baidu.sign('hello world', '1234567890'), 10000)
+        print('%-24s %8.1fus' % ('baidu sign', cost * 1e6))
+        body = json.dumps({'from': 'en', 'to': 'zh', 'trans_result':
+            [{'src': 'hello', 'dst': '你好'}]})
+        cost = timeit(lambda: baidu.parse_response('en', 'zh', 'hello',
+            json.loads(body)), 10000)
+        print('%-24s %8.1fus' % ('baidu parse', cost * 1e6))
+    if 'bing' in engines:
+        bing = engines['bing']
+        url = 'http://127.0.0.1:%d/dict/SerpHoverTrans?q=hello' % port
+        cost = timeit(lambda: bing.http_get(url).text, 50)
+        print('%-24s %8.1fus' % ('bing http', cost * 1e6))
+        cost = timeit(lambda: bing._fetch(url, {}), 50)
+        print('%-24s %8.1fus' % ('bing http+parse stream', cost * 1e6))
+        html = BING_HEAD % 'hello' + BING_TAIL
+        cost = timeit(lambda: bing.parse(html), 1000)
+        print('%-24s %8.1fus' % ('bing parse', cost * 1e6))
+    res = translator.Translation('bingdict', 'auto', 'auto', 'hello')
+    res.phonetic = 'həˈləʊ'
+    res.explain = ['int. 你好', 'n. 招呼']
+    def render ():
+        translator.print_res(res, 'hello', {}, io.StringIO())
+    cost = timeit(render, 10000)
+    print('%-24s %8.1fus' % ('render text', cost * 1e6))
+    def render_json ():
+        translator.print_res(res, 'hello', {'json': ''}, io.StringIO())
+    cost = timeit(render_json, 10000)
+    print('%-24s %8.1fus' % ('render json', cost * 1e6))
+
+
+def bench_offline (options):
+    count = int(options.get('requests', 100))
+    jobs = int(options.get('jobs', 8))
+    names = options.get('engines', 'bing,baidu,tecent').split(',')
+    settings = mock_settings(options)
+    server = start_mock_server(settings)
+    port = server.server_address[1]
+    setup_home(port)
+    sys.path.insert(0, HERE)
+    import translator
+    print('mock latency %.0fms  jitter %.0fms  errors %.0f%%' % (
+        settings.latency * 1000, settings.jitter * 1000, settings.errors * 100))
+    engines = load_engines(translator, [ n for n in names if n ])
+    bench_stages(translator, engines, port)
+    bench_latency(engines, count)
+    bench_fanout(translator, list(engines), max(1, count // 4))
+    bench_batch(translator, engines, count * 5, jobs)
+    server.shutdown()
+    return 0
+
+
+#----------------------------------------------------------------------
+# 主程序
+#----------------------------------------------------------------------
+COMMANDS = {
+    'startup': bench_startup,
+    'offline': bench_offline,
+    'mock': bench_mock,
+}
+
+def main (argv = None):
+    if argv is None:
+        argv = sys.argv
+    options, args = getopt(argv[1:])
+    if not args or args[0] not in COMMANDS:
+        print('usage: benchmark.py {%s} [options]' % '|'.join(COMMANDS))
+        return 0
+    return COMMANDS[args[0]](options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translator
+
+
+def measure_bytes (text):
+    return len(text.encode('utf-8'))
+
+
+class SplitDocumentTest (unittest.TestCase):
+
+    def check (self, text, limit, measure = len):
+        pieces = translator.split_document(text, limit, measure)
+        self.assertEqual(''.join([ piece for _, piece in pieces ]), text)
+        for needed, piece in pieces:
+            if needed:
+                self.assertTrue(piece.strip())
+                self.assertEqual(piece, piece.strip())
+        return pieces
+
+    def test_trailing_spaces (self):
+        self.check('word ' * 400 + '   ', 2000)
+
+    def test_markdown_line_break (self):
+        text = ('A line ending in two spaces.  \n' * 80 + '\n' +
+                'Next paragraph.\n')
+        self.check(text, 200)
+
+    def test_paragraphs_kept (self):
+        text = '  Indented first.\n\n\nSecond paragraph.\n'
+        pieces = self.check(text, 100)
+        chunks = [ piece for needed, piece in pieces if needed ]
+        self.assertEqual(chunks, ['Indented first.', 'Second paragraph.'])
+
+    def test_empty (self):
+        for text in ('', '   \n\n  '):
+            pieces = self.check(text, 100)
+            self.assertFalse([ 1 for needed, _ in pieces if needed ])
+
+    def test_fuzz (self):
+        rand = random.Random(1234)
+        alphabet = [ 'word', 'x', '。', '. ', '! ', '? ', ' ', '  ', '\n',
+                '\n\n', '\t', '中文', 'ü' ]
+        for i in range(2000):
+            text = ''.join([ rand.choice(alphabet)
+                for n in range(rand.randint(0, 120)) ])
+            limit = rand.randint(4, 60)
+            self.check(text, limit, rand.choice([len, measure_bytes]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translator
+
+
+class NormalizeTest (unittest.TestCase):
+
+    def setUp (self):
+        self.memory = translator.TranslationMemory(':memory:')
+
+    def test_case_punct_space (self):
+        self.assertEqual(self.memory.normalize('  Hello,   World! '),
+                'hello world')
+
+    def test_numbers (self):
+        self.assertEqual(self.memory.normalize('Episode 12 of 3.5'),
+                self.memory.normalize('episode 13 of 4,25'))
+
+    def test_words_differ (self):
+        self.assertNotEqual(self.memory.normalize('enable updates'),
+                self.memory.normalize('disable updates'))
+
+
+class PatchTest (unittest.TestCase):
+
+    def setUp (self):
+        self.memory = translator.TranslationMemory(':memory:')
+
+    def test_unchanged (self):
+        self.assertEqual(self.memory.patch('Hello.', 'hello', '你好'), '你好')
+
+    def test_replace_number (self):
+        output = self.memory.patch('Episode 12', 'Episode 13', '第 12 集')
+        self.assertEqual(output, '第 13 集')
+
+    def test_count_mismatch (self):
+        self.assertIsNone(self.memory.patch('page 1', 'page 1 of 2', '第 1 页'))
+
+    def test_missing_in_target (self):
+        self.assertIsNone(self.memory.patch('Episode 12', 'Episode 13',
+            '第十二集'))
+
+    def test_inconsistent_mapping (self):
+        self.assertIsNone(self.memory.patch('1 and 1', '2 and 3', '1 和 1'))
+
+
+class FindTest (unittest.TestCase):
+
+    def setUp (self):
+        self.dirname = tempfile.mkdtemp()
+        filename = os.path.join(self.dirname, 'memory.db')
+        self.memory = translator.TranslationMemory(filename)
+        self.source = ('Click the button to enable automatic updates for '
+                'all 12 users.')
+        self.target = '点击按钮为所有 12 个用户启用自动更新。'
+        self.memory.add('baidu', 'en', 'zh', self.source, self.target)
+
+    def tearDown (self):
+        db = self.memory._db
+        if db is not None:
+            db.close()
+        shutil.rmtree(self.dirname)
+
+    def test_exact (self):
+        match = self.memory.find('baidu', 'en', 'zh', self.source)
+        self.assertEqual(match, (self.target, self.source))
+
+    def test_numbers_and_case (self):
+        text = 'click the button to enable automatic updates for all 30 users'
+        output, source = self.memory.find('baidu', 'en', 'zh', text)
+        self.assertEqual(output, '点击按钮为所有 30 个用户启用自动更新。')
+        self.assertEqual(source, self.source)
+
+    def test_similar_not_reused (self):
+        text = ('Click the button to disable automatic updates for '
+                'all 12 users.')
+        self.assertIsNone(self.memory.find('baidu', 'en', 'zh', text))
+        found = self.memory.suggest('baidu', 'en', 'zh', text, 0.8)
+        self.assertEqual(len(found), 1)
+        score, source, target = found[0]
+        self.assertTrue(0.8 <= score < 1.0)
+        self.assertEqual(target, self.target)
+
+    def test_other_language_pair (self):
+        self.assertIsNone(self.memory.find('baidu', 'en', 'jp', self.source))
+        self.assertIsNone(self.memory.find('tecent', 'en', 'zh', self.source))
+
+    def test_empty (self):
+        self.assertIsNone(self.memory.find('baidu', 'en', 'zh', ' ... '))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,12 +21,8 @@ import json
 import codecs
 import pprint
 import threading
+import operator
 
-from tencentcloud.common import credential
-from tencentcloud.common.profile.client_profile import ClientProfile
-from tencentcloud.common.profile.http_profile import HttpProfile
-from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
-from tencentcloud.tmt.v20180321 import tmt_client, models
 
 #----------------------------------------------------------------------
 # 编码兼容
@@ -96,20 +92,107 @@ langmap = {
 
 
 #----------------------------------------------------------------------
-# BasicTranslator
+# 语言检测：按 Unicode 文字区块统计字符，每种文字一次正则扫描，
+# 中日韩按字数计，拼音文字按词数计，拉丁字母再看变音符号区分语种
 #----------------------------------------------------------------------
-class BasicTranslator(object):
+_KANA = re.compile(u'[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]')
+_HAN = re.compile(u'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+_LATIN = re.compile(u'[A-Za-z\u00c0-\u024f\u1e00-\u1eff]+')
 
-    def __init__ (self, name, **argv):
-        self._name = name
-        self._config = {}  
-        self._options = argv
-        self._session = None
-        self._agent = None
-        self._load_config(name)
-        self._check_proxy()
+_SCRIPTS = (
+    ('ko', re.compile(u'[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]')),
+    ('th', re.compile(u'[\u0e00-\u0e7f]')),
+    ('ru', re.compile(u'[\u0400-\u04ff]+')),
+    ('ar', re.compile(u'[\u0600-\u06ff\u0750-\u077f]+')),
+    ('el', re.compile(u'[\u0370-\u03ff]+')),
+    ('he', re.compile(u'[\u0590-\u05ff]+')),
+    ('hi', re.compile(u'[\u0900-\u097f]+')),
+)
+
+# 各语种特有的字母（小写），只在拉丁字母占多数时使用
+_LATIN_HINTS = (
+    ('vi', re.compile(u'[\u0103\u0111\u01a1\u01b0\u1ea0-\u1ef9]')),
+    ('de', re.compile(u'[\u00e4\u00f6\u00fc\u00df]')),
+    ('fr', re.compile(u'[\u00e2\u00e8\u00ea\u00eb\u00ee\u00ef\u00f9\u00fb\u0153]')),
+    ('es', re.compile(u'[\u00f1\u00a1\u00bf\u00e1\u00ed\u00f3\u00fa]')),
+    ('pt', re.compile(u'[\u00e3\u00f5]')),
+    ('pl', re.compile(u'[\u0105\u0107\u0119\u0142\u0144\u015b\u017a\u017c]')),
+    ('tr', re.compile(u'[\u011f\u0131\u015f]')),
+    ('cs', re.compile(u'[\u011b\u010d\u0159\u017e\u016f\u0148]')),
+)
+
+# 长文本只看开头部分
+DETECT_SAMPLE = 4096
+
+def detect_language (text):
+    sample = text[:DETECT_SAMPLE]
+    try:
+        sample.encode('ascii')
+        return _LATIN.search(sample) and 'en-US' or None
+    except UnicodeError:
+        pass
+    scores = {}
+    han = len(_HAN.findall(sample))
+    kana = len(_KANA.findall(sample))
+    # 日文里假名和汉字混用，中文里几乎不出现假名
+    if kana and kana * 5 >= han:
+        scores['ja'] = kana + han
+    elif han:
+        scores['zh-CN'] = han
+    for name, pattern in _SCRIPTS:
+        count = len(pattern.findall(sample))
+        if count:
+            scores[name] = count
+    latin = len(_LATIN.findall(sample))
+    if latin:
+        scores['en-US'] = latin
+    if not scores:
+        return None
+    best = max(scores, key = lambda name: scores[name])
+    if best != 'en-US':
+        return best
+    sample = sample.lower()
+    hints = [ (len(pattern.findall(sample)), name)
+            for name, pattern in _LATIN_HINTS ]
+    count, name = max(hints)
+    return count and name or best
+
+
+#----------------------------------------------------------------------
+# 配置目录
+#----------------------------------------------------------------------
+def config_path (name):
+    return os.path.expanduser('~/.config/translator/' + name)
+
+
+#----------------------------------------------------------------------
+# 配置：进程内只解析一次，文件的修改时间或大小变化时重新加载
+#----------------------------------------------------------------------
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = dict
+
+
+class ConfigStore (object):
+
+    def __init__ (self, filename, interval = 1.0):
+        self._filename = filename
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._checked = 0
+        self._config = None
+        self._views = {}
+
+    def _stat (self):
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
 
-    def __load_ini (self, ininame, codec = None):
+    def _load_ini (self, ininame, codec = None):
         config = {}
         if not ininame:
             return None
@@ -152,33 +235,1419 @@ class BasicTranslator(object):
             config['default'] = {}
         return config
 
-    def _load_config (self, name):
-        self._config = {}
-        ininame = os.path.expanduser('~/.config/translator/config.ini')
-        config = self.__load_ini(ininame)
-        if not config:
+    def _reload (self):
+        now = time.time()
+        if self._config is not None and now - self._checked < self._interval:
             return False
-        for section in ('default', name):
-            items = config.get(section, {})
-            for key in items:
-                self._config[key] = items[key]
+        self._checked = now
+        stamp = self._stat()
+        if self._config is not None and stamp == self._stamp:
+            return False
+        self._config = self._load_ini(self._filename) or {'default': {}}
+        self._stamp = stamp
+        self._views = {}
         return True
 
-    def _check_proxy (self):
-        proxy = os.environ.get('all_proxy', None)
-        if not proxy:
-            return False
-        if not isinstance(proxy, str):
+    # 返回某个引擎的只读配置：[default] 和引擎小节合并后的结果
+    def get (self, name):
+        with self._lock:
+            self._reload()
+            view = self._views.get(name)
+            if view is not None:
+                return view
+            config = {}
+            for section in ('default', name):
+                config.update(self._config.get(section, {}))
+            proxy = os.environ.get('all_proxy', None)
+            if proxy and isinstance(proxy, str) and 'proxy' not in config:
+                config['proxy'] = proxy.strip()
+            view = MappingProxyType(config)
+            self._views[name] = view
+        return view
+
+
+_config_lock = threading.Lock()
+_config_store = None
+
+def get_config_store ():
+    global _config_store
+    with _config_lock:
+        if _config_store is None:
+            _config_store = ConfigStore(config_path('config.ini'))
+    return _config_store
+
+
+#----------------------------------------------------------------------
+# 翻译缓存：单个 sqlite 文件，LRU 淘汰，各引擎可单独设置过期时间
+#----------------------------------------------------------------------
+class TranslationCache (object):
+
+    def __init__ (self, filename, capacity = 20000):
+        self._filename = filename
+        self._capacity = max(1, capacity)
+        self._lock = threading.Lock()
+        self._db = None
+        self._count = 0
+        self._broken = False
+        self.hits = 0
+        self.misses = 0
+
+    def _open (self):
+        if self._db is not None or self._broken:
+            return self._db
+        import sqlite3
+        try:
+            dirname = os.path.dirname(self._filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            db = sqlite3.connect(self._filename, timeout = 5,
+                    isolation_level = None, check_same_thread = False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                    'key TEXT PRIMARY KEY, engine TEXT, value TEXT, '
+                    'ctime REAL, atime REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_atime '
+                    'ON cache (atime)')
+            self._count = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        except (sqlite3.Error, OSError, IOError):
+            # 缓存不可用时直接走网络，不影响翻译
+            self._broken = True
+            return None
+        self._db = db
+        return db
+
+    # 结果结构变化时增加版本号，旧格式的记录自然失效
+    SCHEMA = '2'
+
+    def make_key (self, engine, sl, tl, text):
+        data = '\0'.join((self.SCHEMA, engine, sl or '', tl or '', text))
+        import hashlib
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get (self, engine, sl, tl, text, ttl = 0):
+        import sqlite3
+        key = self.make_key(engine, sl, tl, text)
+        now = time.time()
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return None
+            try:
+                row = db.execute('SELECT value, ctime, atime FROM cache '
+                        'WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value, ctime, atime = row
+                if ttl > 0 and now - ctime > ttl:
+                    db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                    self._count -= 1
+                    self.misses += 1
+                    return None
+                # 访问时间精确到分钟即可，避免每次命中都写盘
+                if now - atime > 60:
+                    db.execute('UPDATE cache SET atime = ? WHERE key = ?',
+                            (now, key))
+            except sqlite3.Error:
+                return None
+            self.hits += 1
+        return Translation.from_dict(json.loads(value))
+
+    def put (self, engine, sl, tl, text, res):
+        import sqlite3
+        key = self.make_key(engine, sl, tl, text)
+        data = res.to_dict()
+        # 原始返回和状态字段不进缓存
+        data['raw'] = data['cache'] = data['tm'] = None
+        value = _json_encoder.encode(data)
+        now = time.time()
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return False
+            try:
+                db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                        (key, engine, value, now, now))
+                self._count += 1
+                if self._count > self._capacity:
+                    self._evict(db)
+            except sqlite3.Error:
+                return False
+        return True
+
+    def _evict (self, db):
+        # 其它进程也会写入，淘汰前重新统计一次
+        self._count = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if self._count <= self._capacity:
+            return 0
+        # 多淘汰 10%，避免每次插入都触发
+        size = self._count - self._capacity + self._capacity // 10
+        db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                'ORDER BY atime LIMIT ?)', (size,))
+        self._count -= size
+        return size
+
+    def stats (self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_cache_lock = threading.Lock()
+_cache_instance = None
+
+def get_cache (capacity = 20000):
+    global _cache_instance
+    with _cache_lock:
+        if _cache_instance is None:
+            filename = config_path('cache.db')
+            _cache_instance = TranslationCache(filename, capacity)
+    return _cache_instance
+
+
+#----------------------------------------------------------------------
+# 请求合并：同一时刻相同的请求只发出一次，其余调用者共享结果
+#----------------------------------------------------------------------
+class _Call (object):
+
+    def __init__ (self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight (object):
+
+    def __init__ (self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    # 返回 (结果, 是否共享了其它调用者的请求)
+    def do (self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        # 调用者会修改结果，有人共享时自己也拿一份副本
+        if call.waiters:
+            return copy.deepcopy(call.result), False
+        return call.result, False
+
+
+_inflight = SingleFlight()
+
+
+#----------------------------------------------------------------------
+# 微批处理：并发到达的请求在很短的窗口内合并成一次接口调用，
+# 第一个到达的调用者负责发送，结果按位置拆回给各个调用者
+#----------------------------------------------------------------------
+class _Batch (object):
+
+    def __init__ (self):
+        self.texts = []
+        self.size = 0
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class MicroBatcher (object):
+
+    def __init__ (self):
+        self._lock = threading.Lock()
+        self._open = {}
+        self._active = 0
+
+    # func(key, texts) 返回和 texts 一一对应的结果列表
+    def submit (self, key, text, func, window, count, limit, measure):
+        size = measure(text)
+        with self._lock:
+            self._active += 1
+            batch = self._open.get(key)
+            if batch is not None and batch.size + size > limit:
+                del self._open[key]
+                batch.full.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch()
+                # 没有其它请求在进行时不用等待，交互查询不增加延迟
+                idle = self._active == 1
+            index = len(batch.texts)
+            batch.texts.append(text)
+            batch.size += size
+            if len(batch.texts) >= count:
+                del self._open[key]
+                batch.full.set()
+        try:
+            if leader:
+                if not idle:
+                    batch.full.wait(window)
+                with self._lock:
+                    if self._open.get(key) is batch:
+                        del self._open[key]
+                try:
+                    batch.results = func(key, batch.texts)
+                except Exception as e:
+                    batch.error = e
+                finally:
+                    batch.done.set()
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._active -= 1
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+
+#----------------------------------------------------------------------
+# 调度器：固定数量的工作线程，每个引擎每个通道的队列有长度上限，
+# 交互查询优先于批量任务；交互查询排不上队时立即返回 busy，
+# 批量任务则阻塞等待，突发请求下延迟可预期，线程和连接数有上限
+#----------------------------------------------------------------------
+class Busy (Exception):
+    pass
+
+
+class _Task (object):
+
+    def __init__ (self, engine, lane, func, args, expires):
+        from concurrent.futures import Future
+        self.engine = engine
+        self.lane = lane
+        self.func = func
+        self.args = args
+        self.expires = expires
+        self.future = Future()
+
+
+class Dispatcher (object):
+
+    INTERACTIVE = 0
+    BATCH = 1
+
+    def __init__ (self, workers = 16, queue_size = 64):
+        import collections
+        self._cond = threading.Condition()
+        self._workers = max(2, workers)
+        self._queue_size = max(1, queue_size)
+        # 批量任务最多占用 3/4 的线程，给交互查询留出余量
+        self._batch_limit = self._workers - max(1, self._workers // 4)
+        # 单个引擎最多占用一半线程，慢引擎不会拖住其它引擎
+        self._engine_limit = max(1, self._workers // 2)
+        self._queues = ({}, {})
+        self._ready = (collections.deque(), collections.deque())
+        self._running = [0, 0]
+        self._active = {}
+        self._threads = []
+
+    def _start (self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target = self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    # 在持有锁时调用：先交互通道，各引擎之间轮流取任务
+    def _next (self):
+        for lane in (self.INTERACTIVE, self.BATCH):
+            if lane == self.BATCH and self._running[lane] >= self._batch_limit:
+                continue
+            ready = self._ready[lane]
+            for i in range(len(ready)):
+                engine = ready[0]
+                ready.rotate(-1)
+                if self._active.get(engine, 0) >= self._engine_limit:
+                    continue
+                queue = self._queues[lane][engine]
+                task = queue.popleft()
+                if not queue:
+                    ready.remove(engine)
+                self._running[lane] += 1
+                self._active[engine] = self._active.get(engine, 0) + 1
+                self._cond.notify_all()
+                return task
+        return None
+
+    def _run (self):
+        while True:
+            with self._cond:
+                task = self._next()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next()
+            # 排队期间已经超过截止时间的任务不再执行
+            if task.expires is not None and time.time() > task.expires:
+                metrics.count(task.engine, 'expired')
+                task.future.set_exception(Busy('expired in queue'))
+            elif task.future.set_running_or_notify_cancel():
+                try:
+                    result = task.func(*task.args)
+                except BaseException as e:
+                    task.future.set_exception(e)
+                else:
+                    task.future.set_result(result)
+            with self._cond:
+                self._running[task.lane] -= 1
+                self._active[task.engine] -= 1
+                self._cond.notify_all()
+
+    # 队列满时交互通道抛出 Busy，block 为真时等待空位
+    def submit (self, engine, lane, func, args = (), expires = None,
+            block = False):
+        with self._cond:
+            self._start()
+            queue = self._queues[lane].get(engine)
+            if queue is None:
+                import collections
+                queue = self._queues[lane][engine] = collections.deque()
+            while len(queue) >= self._queue_size:
+                if not block:
+                    metrics.count(engine, 'busy')
+                    raise Busy('%s: queue is full' % engine)
+                self._cond.wait()
+            task = _Task(engine, lane, func, args, expires)
+            if not queue:
+                self._ready[lane].append(engine)
+            queue.append(task)
+            self._cond.notify_all()
+        return task.future
+
+    def executor (self, engine, jobs):
+        return LaneExecutor(self, engine, jobs)
+
+
+# 批量通道的执行器：接口和 ThreadPoolExecutor 相同，最多 jobs 个任务同时进行
+class LaneExecutor (object):
+
+    def __init__ (self, dispatcher, engine, jobs):
+        self._dispatcher = dispatcher
+        self._engine = engine
+        self._slots = threading.Semaphore(max(1, jobs))
+
+    def submit (self, func, *args):
+        self._slots.acquire()
+        try:
+            future = self._dispatcher.submit(self._engine,
+                    Dispatcher.BATCH, func, args, block = True)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def map (self, func, items):
+        futures = [ self.submit(func, item) for item in items ]
+        return [ future.result() for future in futures ]
+
+
+_dispatcher_lock = threading.Lock()
+_dispatcher = None
+
+def get_dispatcher ():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            config = get_config_store().get('default')
+            _dispatcher = Dispatcher(int(config.get('workers', 16)),
+                    int(config.get('queue_size', 64)))
+    return _dispatcher
+
+
+#----------------------------------------------------------------------
+# 翻译记忆：保存原文/译文对，只有数字、标点或大小写不同的句子直接复用
+# （数字会替换成新的）；相近的句子按字符 n-gram 倒排索引检索，只作为参考
+#----------------------------------------------------------------------
+_TM_NUMBER = re.compile(r'\d+(?:[.,:]\d+)*')
+_TM_PUNCT = re.compile(r'[^\w\s]+|_+', re.UNICODE)
+_TM_SPACE = re.compile(r'\s+', re.UNICODE)
+
+class TranslationMemory (object):
+
+    NGRAM = 3
+    PROBE = 200     # 检索候选时最多使用的 n-gram 个数
+    CANDIDATES = 8
+
+    def __init__ (self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._db = None
+        self._broken = False
+        self.hits = 0
+        self.misses = 0
+
+    def _open (self):
+        if self._db is not None or self._broken:
+            return self._db
+        import sqlite3
+        try:
+            dirname = os.path.dirname(self._filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            db = sqlite3.connect(self._filename, timeout = 5,
+                    isolation_level = None, check_same_thread = False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS units ('
+                    'id INTEGER PRIMARY KEY, engine TEXT, sl TEXT, tl TEXT, '
+                    'source TEXT, norm TEXT, target TEXT, size INTEGER, '
+                    'UNIQUE (engine, sl, tl, source))')
+            db.execute('CREATE INDEX IF NOT EXISTS units_norm '
+                    'ON units (engine, sl, tl, norm)')
+            db.execute('CREATE TABLE IF NOT EXISTS grams ('
+                    'gram TEXT, unit INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS grams_gram '
+                    'ON grams (gram)')
+        except (sqlite3.Error, OSError, IOError):
+            self._broken = True
+            return None
+        self._db = db
+        return db
+
+    # 归一化：小写，数字统一成 0，去掉标点，合并空白
+    def normalize (self, text):
+        text = _TM_NUMBER.sub('0', text.lower())
+        text = _TM_PUNCT.sub(' ', text)
+        return _TM_SPACE.sub(' ', text).strip()
+
+    def grams (self, norm):
+        n = self.NGRAM
+        if len(norm) <= n:
+            return set([norm])
+        return set([ norm[i:i + n] for i in range(len(norm) - n + 1) ])
+
+    # 原文中改变了的数字在译文里替换成新值，无法对应时返回 None
+    def patch (self, source, text, target):
+        old = _TM_NUMBER.findall(source)
+        new = _TM_NUMBER.findall(text)
+        if len(old) != len(new):
+            return None
+        mapping = {}
+        for a, b in zip(old, new):
+            if mapping.get(a, b) != b:
+                return None
+            mapping[a] = b
+        changed = [ a for a in mapping if mapping[a] != a ]
+        found = set(_TM_NUMBER.findall(target))
+        for a in changed:
+            if a not in found:
+                return None
+        if not changed:
+            return target
+        return _TM_NUMBER.sub(lambda m: mapping.get(m.group(0), m.group(0)),
+                target)
+
+    def add (self, engine, sl, tl, source, target):
+        import sqlite3
+        if not source.strip() or not target:
             return False
-        if 'proxy' not in self._config:
-            self._config['proxy'] = proxy.strip()
+        norm = self.normalize(source)
+        grams = self.grams(norm)
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return False
+            try:
+                db.execute('BEGIN')
+                cursor = db.execute('INSERT OR IGNORE INTO units (engine, sl, '
+                        'tl, source, norm, target, size) VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?)', (engine, sl or '', tl or '',
+                        source, norm, target, len(grams)))
+                if cursor.rowcount > 0:
+                    unit = cursor.lastrowid
+                    db.executemany('INSERT INTO grams VALUES (?, ?)',
+                            [ (gram, unit) for gram in grams ])
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                try:
+                    db.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                return False
         return True
 
-    def request (self, url, data = None, post = False, header = None):
+    def _query (self, method, engine, sl, tl, text, *args):
+        import sqlite3
+        norm = self.normalize(text)
+        if not norm:
+            return None
+        key = (engine, sl or '', tl or '')
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return None
+            try:
+                return method(db, key, text, norm, *args)
+            except sqlite3.Error:
+                return None
+
+    # 可以直接复用的译文，返回 (译文, 原文)，没有时返回 None
+    def find (self, engine, sl, tl, text):
+        match = self._query(self._find, engine, sl, tl, text)
+        with self._lock:
+            if match is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return match
+
+    def _find (self, db, key, text, norm):
+        # 归一化后完全相同：只可能是数字、标点或大小写不同
+        rows = db.execute('SELECT source, target FROM units WHERE engine = ? '
+                'AND sl = ? AND tl = ? AND norm = ? LIMIT 4', key + (norm,))
+        for source, target in rows.fetchall():
+            output = self.patch(source, text, target)
+            if output is not None:
+                return output, source
+        return None
+
+    # 相近的句子只作为参考：返回 [(相似度, 原文, 译文)]，按相似度从高到低，
+    # 不会替代接口的结果
+    def suggest (self, engine, sl, tl, text, threshold = 0.9, limit = 3):
+        found = self._query(self._suggest, engine, sl, tl, text, threshold)
+        return (found or [])[:limit]
+
+    def _suggest (self, db, key, text, norm, threshold):
+        grams = self.grams(norm)
+        probe = sorted(grams)[:self.PROBE]
+        size = len(grams)
+        # Dice 系数达到阈值时，两边 n-gram 个数的比例有上下限
+        low = int(size * threshold / (2.0 - threshold))
+        high = int(size * (2.0 - threshold) / threshold) + 1
+        sql = ('SELECT u.id, u.source, u.norm, u.target, COUNT(*) AS n '
+                'FROM grams g JOIN units u ON u.id = g.unit '
+                'WHERE g.gram IN (%s) AND u.engine = ? AND u.sl = ? '
+                'AND u.tl = ? AND u.size BETWEEN ? AND ? '
+                'GROUP BY u.id ORDER BY n DESC LIMIT ?')
+        sql = sql % ','.join('?' * len(probe))
+        args = tuple(probe) + key + (low, high, self.CANDIDATES)
+        found = []
+        for unit, source, other, target, n in db.execute(sql, args):
+            if other == norm:
+                continue
+            candidate = self.grams(other)
+            score = 2.0 * len(grams & candidate) / (size + len(candidate))
+            if score >= threshold:
+                found.append((score, source, target))
+        found.sort(key = lambda item: -item[0])
+        return found
+
+    def stats (self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_memory_lock = threading.Lock()
+_memory_instance = None
+
+def get_memory ():
+    global _memory_instance
+    with _memory_lock:
+        if _memory_instance is None:
+            _memory_instance = TranslationMemory(config_path('memory.db'))
+    return _memory_instance
+
+
+#----------------------------------------------------------------------
+# 连接池：按引擎和代理复用 requests.Session / TmtClient，
+# 同一时间一个客户端只被一个线程使用，空闲太久的自动关闭
+#----------------------------------------------------------------------
+class ClientPool (object):
+
+    def __init__ (self):
+        self._cond = threading.Condition()
+        self._idle = {}         # key -> [(client, 最后使用时间)]
+        self._count = {}        # key -> 已创建的客户端数量
+
+    def acquire (self, key, factory, size = 4, idle = 60):
+        with self._cond:
+            self._evict(idle)
+            while True:
+                clients = self._idle.get(key)
+                if clients:
+                    return clients.pop()[0]
+                if self._count.get(key, 0) < size:
+                    self._count[key] = self._count.get(key, 0) + 1
+                    break
+                self._cond.wait()
+        try:
+            return factory()
+        except:
+            with self._cond:
+                self._count[key] -= 1
+                self._cond.notify()
+            raise
+
+    def release (self, key, client):
+        with self._cond:
+            self._idle.setdefault(key, []).append((client, time.time()))
+            self._cond.notify()
+
+    # 出错的客户端直接丢弃，不再放回池里
+    def discard (self, key, client):
+        self._close(client)
+        with self._cond:
+            self._count[key] -= 1
+            self._cond.notify()
+
+    def _close (self, client):
+        close = getattr(client, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def _evict (self, idle):
+        limit = time.time() - idle
+        for key, clients in self._idle.items():
+            while clients and clients[0][1] < limit:
+                client = clients.pop(0)[0]
+                self._count[key] -= 1
+                self._close(client)
+
+    def clear (self):
+        with self._cond:
+            for key, clients in self._idle.items():
+                for client, _ in clients:
+                    self._count[key] -= 1
+                    self._close(client)
+            self._idle = {}
+            self._cond.notify_all()
+
+
+class PooledClient (object):
+
+    def __init__ (self, pool, key, factory, size, idle):
+        self._pool = pool
+        self._key = key
+        self._factory = factory
+        self._size = size
+        self._idle = idle
+        self._client = None
+
+    def __enter__ (self):
+        self._client = self._pool.acquire(self._key, self._factory,
+                self._size, self._idle)
+        return self._client
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._pool.release(self._key, self._client)
+        else:
+            self._pool.discard(self._key, self._client)
+        self._client = None
+        return False
+
+
+_client_pool = ClientPool()
+
+
+#----------------------------------------------------------------------
+# 错误和限速
+#----------------------------------------------------------------------
+class TranslatorError (Exception):
+
+    # kind: throttled 被服务商限流，retry 可以重试，fatal 不可重试，
+    # open 表示引擎处于熔断状态被跳过
+    def __init__ (self, engine, message, code = None, kind = 'fatal'):
+        super(TranslatorError, self).__init__('%s: %s' % (engine, message))
+        self.engine = engine
+        self.code = code
+        self.kind = kind
+
+
+# 令牌桶：每秒补充 qps 个令牌，最多积攒 burst 个
+class RateLimiter (object):
+
+    def __init__ (self, qps, burst = 1):
+        self._lock = threading.Lock()
+        self.configure(qps, burst)
+        self._tokens = self._burst
+        self._stamp = time.time()
+
+    def configure (self, qps, burst = 1):
+        self._qps = qps
+        self._burst = max(1, burst)
+
+    # 取一个令牌，不够时先预订再等待，多个线程按先后顺序排队
+    def acquire (self):
+        if self._qps <= 0:
+            return 0
+        with self._lock:
+            now = time.time()
+            tokens = self._tokens + (now - self._stamp) * self._qps
+            self._tokens = min(self._burst, tokens) - 1
+            self._stamp = now
+            wait = max(0, -self._tokens / self._qps)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_limiter_lock = threading.Lock()
+_limiters = {}
+
+def get_limiter (name, qps, burst = 1):
+    with _limiter_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(qps, burst)
+            _limiters[name] = limiter
+        else:
+            limiter.configure(qps, burst)
+    return limiter
+
+
+#----------------------------------------------------------------------
+# 引擎健康状态：按最近的延迟自适应超时，连续失败后熔断一段时间，
+# 状态保存在 health.json 里，每次只运行一下的命令行进程也能用上
+#----------------------------------------------------------------------
+class EngineHealth (object):
+
+    SAMPLES = 64            # 每个引擎保留的延迟样本数
+    MIN_SAMPLES = 8         # 样本不足时使用配置的固定超时
+    INTERVAL = 1.0          # 重新检查文件的最小间隔（秒）
+    SAVE_INTERVAL = 5.0     # 只有延迟样本变化时的最小写盘间隔
+
+    def __init__ (self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._states = {}
+        self._probing = set()
+        self._mtime = None
+        self._checked = 0
+        self._saved = 0
+        self._dirty = False
+
+    def _state (self, name):
+        state = self._states.get(name)
+        if state is None:
+            state = {'state': 'closed', 'failures': 0, 'opened': 0,
+                    'samples': [], 'outcomes': []}
+            self._states[name] = state
+        return state
+
+    # 其它进程更新过文件时读入熔断状态，本进程未保存的延迟样本优先
+    def _refresh (self):
+        now = time.time()
+        if now - self._checked < self.INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self._filename).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with codecs.open(self._filename, 'r', 'utf-8') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        for name, item in data.items():
+            if not isinstance(item, dict):
+                continue
+            state = self._state(name)
+            for key in ('state', 'failures', 'opened'):
+                if key in item:
+                    state[key] = item[key]
+            if not self._dirty:
+                for key in ('samples', 'outcomes'):
+                    if isinstance(item.get(key), list):
+                        state[key] = item[key][-self.SAMPLES:]
+
+    def _save (self, force = False):
+        now = time.time()
+        if not force and now - self._saved < self.SAVE_INTERVAL:
+            self._dirty = True
+            return
+        temp = '%s.%d.tmp' % (self._filename, os.getpid())
+        try:
+            dirname = os.path.dirname(self._filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with codecs.open(temp, 'w', 'utf-8') as fp:
+                json.dump(self._states, fp)
+            os.replace(temp, self._filename)
+            self._mtime = os.stat(self._filename).st_mtime
+        except (IOError, OSError):
+            return
+        self._saved = now
+        self._dirty = False
+
+    def flush (self):
+        with self._lock:
+            if self._dirty:
+                self._save(True)
+
+    # 超时取最近 p95 的若干倍，不超过配置的 timeout
+    def timeout (self, name, config):
+        ceiling = float(config.get('timeout', 7) or 0)
+        value = config.get('adaptive_timeout', 'yes')
+        if value.lower() in ('0', 'no', 'false', 'off'):
+            return ceiling
+        with self._lock:
+            self._refresh()
+            samples = sorted(self._state(name)['samples'])
+        if len(samples) < self.MIN_SAMPLES:
+            return ceiling
+        p95 = samples[int(round((len(samples) - 1) * 0.95))]
+        value = p95 * float(config.get('timeout_factor', 3))
+        value = max(float(config.get('timeout_min', 1.0)), value)
+        if ceiling > 0:
+            value = min(ceiling, value)
+        return value
+
+    # 熔断打开时拒绝请求，冷却时间过后只放行一个探测请求
+    def allow (self, name, config):
+        if int(config.get('breaker_failures', 3)) <= 0:
+            return True
+        cooldown = float(config.get('breaker_cooldown', 30))
+        with self._lock:
+            self._refresh()
+            state = self._state(name)
+            if state['state'] == 'closed':
+                return True
+            now = time.time()
+            if now - state['opened'] < cooldown:
+                return False
+            if state['state'] == 'half' and name in self._probing:
+                return False
+            # 探测请求超过冷却时间仍没有结果（比如进程被杀掉），重新探测
+            state['state'] = 'half'
+            state['opened'] = now
+            self._probing.add(name)
+            self._save(True)
+        return True
+
+    def success (self, name, elapsed = None):
+        with self._lock:
+            state = self._state(name)
+            if elapsed is not None:
+                state['samples'].append(round(elapsed, 4))
+                del state['samples'][:-self.SAMPLES]
+                self._outcome(state, 1)
+            self._probing.discard(name)
+            changed = state['state'] != 'closed' or state['failures'] > 0
+            state['state'] = 'closed'
+            state['failures'] = 0
+            self._save(changed)
+
+    # 既不算成功也不算失败，半开状态下冷却时间过后再探测
+    def release (self, name):
+        with self._lock:
+            self._probing.discard(name)
+
+    # 返回 True 表示熔断刚刚打开
+    def failure (self, name, config):
+        threshold = int(config.get('breaker_failures', 3))
+        with self._lock:
+            state = self._state(name)
+            state['failures'] += 1
+            self._outcome(state, 0)
+            self._probing.discard(name)
+            tripped = False
+            if threshold > 0 and (state['state'] == 'half' or
+                    state['failures'] >= threshold):
+                tripped = state['state'] != 'open'
+                state['state'] = 'open'
+                state['opened'] = time.time()
+            self._save(True)
+        return tripped
+
+    # 最近的请求结果，1 成功 0 失败，用来计算成功率
+    def _outcome (self, state, value):
+        outcomes = state.setdefault('outcomes', [])
+        outcomes.append(value)
+        del outcomes[:-self.SAMPLES]
+
+    # 只读检查：熔断关闭，或者冷却时间已过可以探测
+    def available (self, name, config):
+        if int(config.get('breaker_failures', 3)) <= 0:
+            return True
+        cooldown = float(config.get('breaker_cooldown', 30))
+        with self._lock:
+            self._refresh()
+            state = self._state(name)
+            if state['state'] == 'closed':
+                return True
+            return time.time() - state['opened'] >= cooldown
+
+    # 返回 (p50, p95, 成功率)，样本不足时对应的值为 None
+    def summary (self, name):
+        with self._lock:
+            self._refresh()
+            state = self._state(name)
+            samples = sorted(state['samples'])
+            outcomes = list(state.get('outcomes', ()))
+        p50 = p95 = rate = None
+        if len(samples) >= self.MIN_SAMPLES:
+            p50 = samples[int(round((len(samples) - 1) * 0.5))]
+            p95 = samples[int(round((len(samples) - 1) * 0.95))]
+        if len(outcomes) >= self.MIN_SAMPLES:
+            rate = float(sum(outcomes)) / len(outcomes)
+        return p50, p95, rate
+
+    def snapshot (self):
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._states)
+
+
+_health_lock = threading.Lock()
+_health_instance = None
+
+def get_health ():
+    global _health_instance
+    with _health_lock:
+        if _health_instance is None:
+            import atexit
+            _health_instance = EngineHealth(config_path('health.json'))
+            atexit.register(_health_instance.flush)
+    return _health_instance
+
+# send() 在当前线程里记下本次尝试的超时，request() 据此设置
+_send_local = threading.local()
+
+
+#----------------------------------------------------------------------
+# 用量统计：各引擎每月实际发送给服务商的字符数，保存在 usage.json，
+# 写盘时和文件里的数值合并，多个进程同时运行也不会丢失计数
+#----------------------------------------------------------------------
+class UsageMeter (object):
+
+    SAVE_INTERVAL = 5.0
+
+    def __init__ (self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._saved = {}
+        self._delta = {}
+        self._stamp = 0
+        self._loaded = False
+
+    def month (self):
+        return time.strftime('%Y-%m')
+
+    def _read (self):
+        try:
+            with codecs.open(self._filename, 'r', 'utf-8') as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+        return isinstance(data, dict) and data or {}
+
+    def _save (self):
+        data = self._read()
+        for month, engines in self._delta.items():
+            item = data.setdefault(month, {})
+            for name, count in engines.items():
+                item[name] = item.get(name, 0) + count
+        temp = '%s.%d.tmp' % (self._filename, os.getpid())
+        try:
+            dirname = os.path.dirname(self._filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with codecs.open(temp, 'w', 'utf-8') as fp:
+                json.dump(data, fp)
+            os.replace(temp, self._filename)
+        except (IOError, OSError):
+            return
+        self._saved = data
+        self._delta = {}
+        self._stamp = time.time()
+
+    def add (self, name, count):
+        month = self.month()
+        with self._lock:
+            item = self._delta.setdefault(month, {})
+            item[name] = item.get(name, 0) + count
+            if time.time() - self._stamp >= self.SAVE_INTERVAL:
+                self._save()
+
+    def flush (self):
+        with self._lock:
+            if self._delta:
+                self._save()
+
+    # 本月各引擎已经使用的字符数
+    def snapshot (self):
+        month = self.month()
+        with self._lock:
+            if not self._loaded or time.time() - self._stamp >= \
+                    self.SAVE_INTERVAL:
+                self._saved = self._read()
+                self._stamp = time.time()
+                self._loaded = True
+            counts = dict(self._saved.get(month, {}))
+            for name, count in self._delta.get(month, {}).items():
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    def get (self, name):
+        return self.snapshot().get(name, 0)
+
+
+_usage_lock = threading.Lock()
+_usage_instance = None
+
+def get_usage ():
+    global _usage_instance
+    with _usage_lock:
+        if _usage_instance is None:
+            import atexit
+            _usage_instance = UsageMeter(config_path('usage.json'))
+            atexit.register(_usage_instance.flush)
+    return _usage_instance
+
+
+#----------------------------------------------------------------------
+# 统计：各引擎的计数器和分阶段延迟直方图
+#----------------------------------------------------------------------
+class Histogram (object):
+
+    # 桶的上界（秒），最后还有一个溢出桶
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+            1.0, 2.0, 5.0, 10.0, 30.0)
+
+    def __init__ (self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe (self, value):
+        import bisect
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # 按桶估算分位数，返回所在桶的上界
+    def percentile (self, p):
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                if index < len(self.BOUNDS):
+                    return min(self.BOUNDS[index], self.max)
+                return self.max
+        return self.max
+
+    def as_dict (self):
+        res = {}
+        res['count'] = self.count
+        res['mean'] = self.count and self.total / self.count or None
+        res['min'] = self.min
+        res['max'] = self.max
+        res['p50'] = self.percentile(50)
+        res['p95'] = self.percentile(95)
+        res['p99'] = self.percentile(99)
+        res['buckets'] = list(self.buckets)
+        return res
+
+
+class Timer (object):
+
+    def __init__ (self, metrics, engine, stage):
+        self._metrics = metrics
+        self._engine = engine
+        self._stage = stage
+        self._start = None
+
+    def __enter__ (self):
+        self._start = time.time()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._engine, self._stage,
+                time.time() - self._start)
+        return False
+
+
+# 阶段：connect（DNS + TCP + TLS）、ttfb、http、parse、total、render
+class Metrics (object):
+
+    def __init__ (self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._hooks = []
+
+    # hook(engine, kind, name, value)：kind 为 timing 或 count
+    def add_hook (self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook (self, hook):
+        if hook in self._hooks:
+            self._hooks.remove(hook)
+
+    def _notify (self, engine, kind, name, value):
+        for hook in list(self._hooks):
+            try:
+                hook(engine, kind, name, value)
+            except Exception:
+                pass
+
+    def observe (self, engine, stage, seconds):
+        with self._lock:
+            hist = self._histograms.get((engine, stage))
+            if hist is None:
+                hist = Histogram()
+                self._histograms[(engine, stage)] = hist
+            hist.observe(seconds)
+        if self._hooks:
+            self._notify(engine, 'timing', stage, seconds)
+
+    def count (self, engine, name, n = 1):
+        with self._lock:
+            key = (engine, name)
+            self._counters[key] = self._counters.get(key, 0) + n
+        if self._hooks:
+            self._notify(engine, 'count', name, n)
+
+    def error (self, engine, error):
+        name = error.__class__.__name__
+        if isinstance(error, TranslatorError):
+            name = 'TranslatorError.%s' % error.kind
+            if error.code:
+                name += '.%s' % error.code
+        self.count(engine, 'error.' + name)
+
+    def timer (self, engine, stage):
+        return Timer(self, engine, stage)
+
+    def snapshot (self):
+        res = {}
+        with self._lock:
+            for (engine, name), n in self._counters.items():
+                item = res.setdefault(engine, {'counters': {}, 'latency': {}})
+                item['counters'][name] = n
+            for (engine, stage), hist in self._histograms.items():
+                item = res.setdefault(engine, {'counters': {}, 'latency': {}})
+                item['latency'][stage] = hist.as_dict()
+        return res
+
+    def report (self, fp):
+        ms = lambda n: n is not None and '%.1f' % (n * 1000) or '-'
+        for engine, item in sorted(self.snapshot().items()):
+            fp.write('[%s]\n' % engine)
+            for name, n in sorted(item['counters'].items()):
+                fp.write('  %-28s %d\n' % (name, n))
+            for stage, hist in sorted(item['latency'].items()):
+                fp.write('  %-8s n=%-5d mean %sms  p50 %sms  p95 %sms  '
+                        'max %sms\n' % (stage, hist['count'], ms(hist['mean']),
+                        ms(hist['p50']), ms(hist['p95']), ms(hist['max'])))
+
+    def reset (self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+
+metrics = Metrics()
+
+# 当前线程正在请求的引擎，建立连接时记录到对应引擎名下
+_stats_local = threading.local()
+_timed_adapter = []
+
+# requests 不提供连接耗时，这里替换 urllib3 的连接类来计时
+def timed_adapter ():
+    if _timed_adapter:
+        return _timed_adapter[0]()
+    import requests.adapters
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    def timed (base):
+        class TimedConnection (base):
+            def connect (self):
+                start = time.time()
+                base.connect(self)
+                engine = getattr(_stats_local, 'engine', 'unknown')
+                metrics.observe(engine, 'connect', time.time() - start)
+        return TimedConnection
+    class TimedHTTPPool (HTTPConnectionPool):
+        ConnectionCls = timed(HTTPConnection)
+    class TimedHTTPSPool (HTTPSConnectionPool):
+        ConnectionCls = timed(HTTPSConnection)
+    class TimedAdapter (requests.adapters.HTTPAdapter):
+        def init_poolmanager (self, *args, **kwargs):
+            requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': TimedHTTPPool, 'https': TimedHTTPSPool }
+    _timed_adapter.append(TimedAdapter)
+    return TimedAdapter()
+
+
+# 配置里的 stats_hook = 模块名:函数名，启动时加载一次
+def install_stats_hook (config):
+    name = config.get('stats_hook')
+    if not name or name in _installed_hooks:
+        return False
+    module, _, func = name.partition(':')
+    try:
+        import importlib
+        hook = getattr(importlib.import_module(module), func)
+    except (ImportError, AttributeError) as e:
+        sys.stderr.write('error: bad stats_hook %s: %s\n' % (name, e))
+        return False
+    _installed_hooks.append(name)
+    metrics.add_hook(hook)
+    return True
+
+_installed_hooks = []
+
+
+#----------------------------------------------------------------------
+# 翻译结果：所有引擎共用的固定结构，用 __slots__ 减少内存占用，
+# 服务商的原始返回只在需要时（--raw）保留
+#----------------------------------------------------------------------
+class Translation (object):
+
+    __slots__ = ('engine', 'sl', 'tl', 'text', 'phonetic', 'definition',
+            'explain', 'translation', 'alternative', 'raw', 'cache', 'tm')
+
+    def __init__ (self, engine = None, sl = None, tl = None, text = None):
+        self.engine = engine            # 引擎名称
+        self.sl = sl                    # 来源语言
+        self.tl = tl                    # 目标语言
+        self.text = text                # 需要翻译的文本
+        self.phonetic = None            # 音标
+        self.definition = None          # 简单释义
+        self.explain = None             # 分行解释（列表）
+        self.translation = None         # 整句译文
+        self.alternative = None         # 其它译法（列表）
+        self.raw = None                 # 服务商的原始返回
+        self.cache = None               # 缓存状态
+        self.tm = None                  # 翻译记忆状态
+
+    def to_dict (self):
+        return dict(zip(self.__slots__, _translation_fields(self)))
+
+    @classmethod
+    def from_dict (cls, data):
+        res = cls()
+        for name in cls.__slots__:
+            if name in data:
+                setattr(res, name, data[name])
+        return res
+
+    # 兼容按字典访问的旧代码：有值的字段才算存在
+    def __contains__ (self, name):
+        if name not in self.__slots__:
+            return False
+        return getattr(self, name) is not None
+
+    def __getitem__ (self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__ (self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get (self, name, default = None):
+        value = getattr(self, name, None)
+        return value is None and default or value
+
+
+_translation_fields = operator.attrgetter(*Translation.__slots__)
+
+# 紧凑格式的 JSON，标准输出有二进制缓冲区时直接写入，跳过文本层编码
+_json_encoder = json.JSONEncoder(separators = (',', ':'))
+
+def write_json (data, fp, newline = False):
+    text = _json_encoder.encode(data)
+    if newline:
+        text += '\n'
+    buffer = getattr(fp, 'buffer', None)
+    if buffer is None:
+        fp.write(text)
+        return
+    fp.flush()
+    buffer.write(text.encode('utf-8'))
+
+
+#----------------------------------------------------------------------
+# BasicTranslator
+#----------------------------------------------------------------------
+class BasicTranslator(object):
+
+    # 单次请求的文本长度上限，0 表示不支持长文本（文档模式）
+    CHUNK_LIMIT = 0
+
+    # 是否按字符计费，计费的引擎才记录用量
+    BILLED = False
+
+    def __init__ (self, name, **argv):
+        self._name = name
+        self._options = argv
+        self._agent = None
+        self._store = get_config_store()
+        self._batcher = MicroBatcher()
+
+    # 合并了 [default] 和引擎小节的只读配置，配置文件修改后自动更新
+    @property
+    def _config (self):
+        return self._store.get(self._name)
+
+
+    # 导入网络库，多线程查询前在调用线程里执行
+    def preload (self):
+        timed_adapter()
+
+    def _new_session (self):
         import requests
-        if not self._session:
-            self._session = requests.Session()
+        session = requests.Session()
+        session.mount('http://', timed_adapter())
+        session.mount('https://', timed_adapter())
+        return session
+
+    # 从连接池取出一个客户端，用完放回；key 里包含代理，不同代理不混用
+    def pooled (self, key, factory):
+        size = int(self._config.get('pool_size', 4))
+        idle = float(self._config.get('pool_idle', 60))
+        return PooledClient(_client_pool, key, factory, size, idle)
+
+    def request (self, url, data = None, post = False, header = None,
+            stream = False):
         argv = {}
+        if stream:
+            argv['stream'] = True
         if header is not None:
             header = copy.deepcopy(header)
         else:
@@ -186,7 +1655,9 @@ class BasicTranslator(object):
         if self._agent:
             header['User-Agent'] = self._agent
         argv['headers'] = header
-        timeout = self._config.get('timeout', 7)
+        timeout = getattr(_send_local, 'timeout', None)
+        if timeout is None:
+            timeout = self._config.get('timeout', 7)
         proxy = self._config.get('proxy', None)
         if timeout:
             argv['timeout'] = float(timeout)
@@ -199,14 +1670,101 @@ class BasicTranslator(object):
         else:
             if data is not None:
                 argv['data'] = data
-        if not post:
-            r = self._session.get(url, **argv)
-        else:
-            r = self._session.post(url, **argv)
+        key = (self._name, proxy)
+        _stats_local.engine = self._name
+        with self.pooled(key, self._new_session) as session:
+            with metrics.timer(self._name, 'http'):
+                if not post:
+                    r = session.get(url, **argv)
+                else:
+                    r = session.post(url, **argv)
+        if r.elapsed:
+            metrics.observe(self._name, 'ttfb', r.elapsed.total_seconds())
+        # 服务端错误退避重试并计入熔断，429 按限流处理
+        if r.status_code >= 500 or r.status_code == 429:
+            kind = r.status_code == 429 and 'throttled' or 'retry'
+            r.close()
+            raise TranslatorError(self._name, 'HTTP error %d' % r.status_code,
+                    str(r.status_code), kind)
         return r
 
-    def http_get (self, url, data = None, header = None):
-        return self.request(url, data, False, header)
+    # 错误分类：throttled/retry 会退避重试，fatal 直接报错
+    def classify (self, error):
+        if isinstance(error, TranslatorError):
+            return error.kind
+        try:
+            import requests
+        except ImportError:
+            return 'fatal'
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return 'retry'
+        return 'fatal'
+
+    # 发送请求：按配置的 qps 限速，遇到限流或网络错误时
+    # 按带随机抖动的指数退避重试，最终失败抛出 TranslatorError
+    def send (self, func, *args):
+        qps = float(self._config.get('qps', 0))
+        limiter = get_limiter(self._name, qps, int(self._config.get('burst', 1)))
+        retries = int(self._config.get('retries', 2))
+        backoff = float(self._config.get('backoff', 0.5))
+        maximum = float(self._config.get('backoff_max', 8))
+        health = get_health()
+        attempt = 0
+        while True:
+            if not health.allow(self._name, self._config):
+                metrics.count(self._name, 'breaker.reject')
+                raise TranslatorError(self._name, 'circuit open, engine '
+                        'skipped after repeated failures', None, 'open')
+            limiter.acquire()
+            # 重试时不再用自适应超时，避免慢而可用的引擎被误判
+            if attempt == 0:
+                _send_local.timeout = health.timeout(self._name, self._config)
+            else:
+                _send_local.timeout = float(self._config.get('timeout', 7) or 0)
+            start = time.time()
+            try:
+                res = func(*args)
+            except Exception as e:
+                kind = self.classify(e)
+                tripped = False
+                if kind == 'retry':
+                    tripped = health.failure(self._name, self._config)
+                    if tripped:
+                        metrics.count(self._name, 'breaker.open')
+                else:
+                    # 限流和请求本身的错误说明不了引擎是否可用，只结束探测
+                    health.release(self._name)
+                # 熔断刚刚打开时不再重试，报告真正的错误而不是 circuit open
+                if kind == 'fatal' or tripped or attempt >= retries:
+                    if isinstance(e, TranslatorError):
+                        raise
+                    message = str(e) or e.__class__.__name__
+                    raise TranslatorError(self._name, message, None, kind)
+                metrics.count(self._name, 'retry.' + kind)
+                delay = random.uniform(0, min(maximum, backoff * (2 ** attempt)))
+                if kind == 'throttled' and qps > 0:
+                    delay = max(delay, 1.0 / qps)
+                attempt += 1
+                time.sleep(delay)
+            else:
+                health.success(self._name, time.time() - start)
+                return res
+            finally:
+                _send_local.timeout = None
+
+    # 并发请求在 batch_window 毫秒内合并，最多 batch_size 条，
+    # 总长度不超过单次请求的上限；batch_window = 0 时关闭
+    def batched (self, key, text, func):
+        window = float(self._config.get('batch_window', 5)) / 1000.0
+        count = int(self._config.get('batch_size', 16))
+        limit = self.chunk_limit()
+        if window <= 0 or count <= 1 or self.measure(text) > limit:
+            return func(key, [text])[0]
+        return self._batcher.submit(key, text, func, window, count, limit,
+                self.measure)
+
+    def http_get (self, url, data = None, header = None, stream = False):
+        return self.request(url, data, False, header, stream)
 
     def http_post (self, url, data = None, header = None):
         return self.request(url, data, True, header)
@@ -236,34 +1794,123 @@ class BasicTranslator(object):
         return urllib.parse.quote(text)
 
     def create_translation (self, sl = None, tl = None, text = None):
-        res = {}
-        res['engine'] = self._name
-        res['sl'] = sl              # 来源语言
-        res['tl'] = tl              # 目标语言
-        res['text'] = text          # 需要翻译的文本
-        res['phonetic'] = None      # 音标
-        res['definition'] = None    # 简单释义
-        res['explain'] = None       # 分行解释
-        return res
+        return Translation(self._name, sl, tl, text)
 
     # 翻译结果：需要填充如下字段
     def translate (self, sl, tl, text):
         return self.create_translation(sl, tl, text)
 
+    # 引擎内部使用的语言代码，子类按需覆盖
+    def convert_lang (self, lang):
+        return lang
+
+    # 结果的纯文本译文，批量模式按行输出时使用
+    def result_text (self, res):
+        if not res:
+            return ''
+        if res.translation:
+            return res.translation.strip()
+        if res.explain:
+            return '; '.join(res.explain)
+        return res.definition or ''
+
+    # 文本长度，单位和 CHUNK_LIMIT 一致
+    def measure (self, text):
+        return len(text)
+
+    def chunk_limit (self):
+        return int(self._config.get('chunk_size', self.CHUNK_LIMIT))
+
+    # 结果是否可以写入缓存
+    def cacheable (self, res):
+        return bool(res)
+
+    def _cache_enabled (self):
+        value = self._config.get('cache', 'yes')
+        return value.lower() not in ('0', 'no', 'false', 'off')
+
+    # 带缓存的翻译入口：先查本地缓存，未命中再访问网络
+    def lookup (self, sl, tl, text, cache = True, refresh = False,
+            raw = False):
+        start = time.time()
+        try:
+            # 缓存里没有原始返回，需要时重新请求
+            res = self._lookup(sl, tl, text, cache, refresh or raw)
+        except Exception as e:
+            metrics.error(self._name, e)
+            raise
+        metrics.observe(self._name, 'total', time.time() - start)
+        if res and not raw:
+            res.raw = None
+        status = res and res.cache['status'] or 'empty'
+        metrics.count(self._name, 'cache.' + status)
+        return res
+
+    # 相同的请求正在进行时等待它的结果，不再重复访问网络
+    def _translate_shared (self, sl, tl, text):
+        key = (self._name, sl, tl, text)
+        res, shared = _inflight.do(key, self.translate, sl, tl, text)
+        if shared:
+            metrics.count(self._name, 'coalesced')
+        elif res and self.billed():
+            get_usage().add(self._name, len(text))
+        return res, shared
+
+    # 按字符计费的引擎才记录用量，配置了 cost 或 quota 的引擎也算
+    def billed (self):
+        config = self._config
+        return self.BILLED or 'cost' in config or 'quota' in config
+
+    # 路由时判断引擎能否处理这段文本
+    def supports (self, text):
+        return True
+
+    def _lookup (self, sl, tl, text, cache, refresh):
+        if not (cache and self._cache_enabled()):
+            res, shared = self._translate_shared(sl, tl, text)
+            if res:
+                res.cache = {'status': shared and 'shared' or 'off'}
+            return res
+        cache = get_cache(int(self._config.get('cache_size', 20000)))
+        ttl = float(self._config.get('cache_ttl', 30 * 86400))
+        ksl, ktl = self.key_langs(sl, tl, text)
+        res = None
+        if not refresh:
+            res = cache.get(self._name, ksl, ktl, text, ttl)
+        status = 'hit'
+        if res is None:
+            res, shared = self._translate_shared(sl, tl, text)
+            status = refresh and 'refresh' or 'miss'
+            if shared:
+                status = 'shared'
+            elif self.cacheable(res):
+                cache.put(self._name, ksl, ktl, text, res)
+        if res:
+            res.cache = {'status': status}
+            res.cache.update(cache.stats())
+        return res
+
+    # 缓存和翻译记忆使用的语言对，auto 先换成猜测出的语言
+    def key_langs (self, sl, tl, text):
+        sl, tl = self.guess_language(sl, tl, text)
+        return self.convert_lang(sl), self.convert_lang(tl)
+
     # 是否是英文
     def check_english (self, text):
-        for ch in text:
-            if ord(ch) >= 128:
-                return False
+        try:
+            text.encode('ascii')
+        except UnicodeError:
+            return False
         return True
 
-    # 猜测语言
+    # 猜测语言：源语言按文字检测，目标语言中文译英文，其它译中文
     def guess_language (self, sl, tl, text):
-        if ((not sl) or sl == 'auto') and ((not tl) or tl == 'auto'):
-            if self.check_english(text):
-                sl, tl = ('en-US', 'zh-CN')
-            else:
-                sl, tl = ('zh-CN', 'en-US')
+        if (not sl) or sl == 'auto':
+            sl = detect_language(text)
+            if sl is None:
+                sl = (tl and tl != 'auto') and 'auto' or 'en-US'
+        if (not tl) or tl == 'auto':
+            tl = sl.lower().startswith('zh') and 'en-US' or 'zh-CN'
         if sl.lower() in langmap:
             sl = langmap[sl.lower()]
         if tl.lower() in langmap:
@@ -296,49 +1943,100 @@ class BingDict (BasicTranslator):
         self._url = 'http://bing.com/dict/SerpHoverTrans'
         self._cnurl = 'http://cn.bing.com/dict/SerpHoverTrans'
 
+    # 只能查单词
+    def supports (self, text):
+        return len(text.split()) == 1
+
     def translate (self, sl, tl, text):
         url = ('zh' in tl) and self._cnurl or self._url
-        url = self._cnurl
+        url = self._config.get('url', self._cnurl)
         url = url + '?q=' + self.url_quote(text)
         headers = {
             # 'Host': 'cn.bing.com',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
         }
-        try:
-            resp = self.http_get(url, None, headers)
-        except:
-            print("\nbingdict time out")
-            exit(-1)
-        if not resp:
+        found = self.send(self._fetch, url, headers)
+        if found is None:
             return None
-        resp = resp.text
-        res = self.create_translation(sl, tl, text)
-        res['sl'] = 'auto'
-        res['tl'] = 'auto'
-        res['text'] = text
-        res['phonetic'] = self.get_phonetic(resp)
-        res['explain'] = self.get_explain(resp)
+        res = self.create_translation('auto', 'auto', text)
+        res.phonetic = found[0]
+        res.explain = found[1]
         return res
 
+    # 音标和词性释义用同一个正则一次扫描提取
+    _PATTERN = re.compile(
+        r'<span class="ht_attr" lang=".*?">\[(.*?)\] </span>|'
+        r'<span class="ht_pos">(.*?)</span><span class="ht_trs">(.*?)</span>')
+
+    # 释义列表结束后就不用再往下读了
+    _BLOCK_END = '</ul>'
+
+    # 从 pos 开始扫描，结果写入 found = [音标, 释义列表]，返回扫描到的位置
+    def scan (self, html, pos, found):
+        for m in self._PATTERN.finditer(html, pos):
+            phonetic, pos_, trs = m.groups()
+            if phonetic is not None:
+                if found[0] is None:
+                    found[0] = phonetic.strip()
+            else:
+                found[1].append('%s %s' % (pos_, trs))
+            pos = m.end()
+        return pos
+
+    def parse (self, html):
+        found = [None, []]
+        if html:
+            self.scan(html, 0, found)
+        return found
+
+    # 边下载边解析，释义列表结束后停止读取剩下的页面
+    def _fetch (self, url, headers):
+        resp = self.http_get(url, None, headers, True)
+        if not resp:
+            resp.close()
+            return None
+        decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')('replace')
+        found = [None, []]
+        html = ''
+        finished = False
+        parsing = 0
+        for chunk in resp.iter_content(4096):
+            start = time.time()
+            html += decoder.decode(chunk)
+            pos = self.scan(html, 0, found)
+            # 已经扫描过的部分丢掉，只保留可能不完整的尾巴
+            tail = max(html.rfind('<span class="ht_pos">', pos),
+                    html.rfind('<span class="ht_attr"', pos))
+            if tail < 0:
+                tail = max(pos, len(html) - 32)
+            html = html[tail:]
+            parsing += time.time() - start
+            if found[1] and html.find(self._BLOCK_END) >= 0:
+                finished = True
+                break
+        metrics.observe(self._name, 'parse', parsing)
+        if finished:
+            self._discard(resp)
+        return found
+
+    # 剩下的内容不多时读完，保留长连接；否则直接断开
+    def _discard (self, resp):
+        size = resp.headers.get('Content-Length')
+        if size and size.isdigit() and int(size) - resp.raw.tell() <= 16384:
+            for chunk in resp.iter_content(16384):
+                pass
+        resp.close()
+
     def get_phonetic (self, html):
         if not html:
             return ''
-        m = re.findall(
-            r'<span class="ht_attr" lang=".*?">\[(.*?)\] </span>', html)
-        if not m:
-            return None
-        return m[0].strip()
+        return self.parse(html)[0]
 
     def get_explain (self, html):
         if not html:
             return []
-        m = re.findall(
-            r'<span class="ht_pos">(.*?)</span><span class="ht_trs">(.*?)</span>', html)
-        expls = []
-        for item in m:
-            expls.append('%s %s' % item)
-        return expls
+        return self.parse(html)[1]
 
 
 
@@ -347,34 +2045,63 @@ class BingDict (BasicTranslator):
 #----------------------------------------------------------------------
 class BaiduTranslator (BasicTranslator):
 
+    # 百度的 q 参数最长约 6000 字节
+    CHUNK_LIMIT = 6000
+    BILLED = True
+
     def __init__ (self, **argv):
         super(BaiduTranslator, self).__init__('baidu', **argv)
         if 'apikey' not in self._config:
-            sys.stderr.write('error: missing apikey in [baidu] section\n')
-            sys.exit()
+            raise TranslatorError(self._name, 'missing apikey in [baidu] section')
         if 'secret' not in self._config:
-            sys.stderr.write('error: missing secret in [baidu] section\n')
-            sys.exit()
-        self.apikey = self._config['apikey']
-        self.secret = self._config['secret']
+            raise TranslatorError(self._name, 'missing secret in [baidu] section')
+        # 百度使用自己的语言代码
         langmap = {
             'zh-cn': 'zh',
             'zh-chs': 'zh',
             'zh-cht': 'cht',
+            'zh-tw': 'cht',
+            'zh-hk': 'cht',
             'en-us': 'en', 
             'en-gb': 'en',
             'ja': 'jp',
+            'ko': 'kor',
+            'fr': 'fra',
+            'es': 'spa',
+            'ar': 'ara',
+            'bg': 'bul',
+            'et': 'est',
+            'da': 'dan',
+            'fi': 'fin',
+            'ro': 'rom',
+            'sl': 'slo',
+            'sv': 'swe',
+            'vi': 'vie',
         }
         self.langmap = langmap
 
+    def measure (self, text):
+        return len(text.encode('utf-8'))
+
+    @property
+    def apikey (self):
+        return self._config['apikey']
+
+    @property
+    def secret (self):
+        return self._config['secret']
+
     def convert_lang (self, lang):
         t = lang.lower()
         if t in self.langmap:
             return self.langmap[t]
         return lang
 
-    def translate (self, sl, tl, text):
-        sl, tl = self.guess_language(sl, tl, text)
+    # 百度的错误码：54003/54005 访问频率受限，52001/52002 超时和系统错误
+    THROTTLED = ('54003', '54005')
+    RETRY = ('52001', '52002')
+
+    def _post (self, text, sl, tl):
         req = {}
         req['q'] = text
         req['from'] = self.convert_lang(sl)
@@ -383,61 +2110,113 @@ class BaiduTranslator (BasicTranslator):
         req['salt'] = str(int(time.time() * 1000) + random.randint(0, 10))
         req['sign'] = self.sign(text, req['salt'])
         url = "https://fanyi-api.baidu.com/api/trans/vip/translate"
+        url = self._config.get('url', url)
+        r = self.http_post(url, req)
+        with metrics.timer(self._name, 'parse'):
+            resp = r.json()
+        code = str(resp.get('error_code', '52000'))
+        if code != '52000':
+            kind = 'fatal'
+            if code in self.THROTTLED:
+                kind = 'throttled'
+            elif code in self.RETRY:
+                kind = 'retry'
+            message = resp.get('error_msg', 'error')
+            raise TranslatorError(self._name, message, code, kind)
+        return resp
+
+    # 多条文本用换行拼成一个 q，百度按行返回结果
+    def _post_batch (self, key, texts):
+        sl, tl = key
+        if len(texts) == 1:
+            return [ self.send(self._post, texts[0], sl, tl) ]
+        metrics.count(self._name, 'batch.calls')
+        metrics.count(self._name, 'batch.items', len(texts))
+        resp = self.send(self._post, '\n'.join(texts), sl, tl)
+        result = resp.get('trans_result') or []
+        if len(result) != len(texts):
+            # 行数对不上时逐条重新请求
+            return [ self.send(self._post, text, sl, tl) for text in texts ]
+        output = []
+        for item in result:
+            part = dict(resp)
+            part['trans_result'] = [item]
+            output.append(part)
+        return output
+
+    def translate (self, sl, tl, text):
+        sl, tl = self.guess_language(sl, tl, text)
+        # 多行文本会被百度拆成多条结果，不参与合并
+        if '\n' in text or not text.strip():
+            resp = self.send(self._post, text, sl, tl)
+        else:
+            resp = self.batched((sl, tl), text, self._post_batch)
+        return self.parse_response(sl, tl, text, resp)
+
+    # 百度的返回转换成 Translation，每行原文对应一条 trans_result
+    def parse_response (self, sl, tl, text, resp):
+        res = self.create_translation(sl, tl, text)
+        res.raw = resp
         try:
-            r = self.http_post(url, req)
-        except:
-            print("\nbaidu time out")
-            exit(-1)
-        resp = r.json()
-        res = {}
-        res['text'] = text
-        res['sl'] = sl
-        res['tl'] = tl
-        res['info'] = resp
-        res['translation'] = self.render(resp)
-        res['html'] = None
-        res['xterm'] = None
-        #print(res)
+            result = resp['trans_result']
+        except (KeyError, TypeError):
+            result = []
+        res.translation = '\n'.join([ item['dst'] for item in result ])
         return res
 
+    def cacheable (self, res):
+        return bool(res and res.translation)
+
     def sign (self, text, salt):
         t = self.apikey + text + salt + self.secret
         return self.md5sum(t)
 
-    def render (self, resp):
-        output = ''
-        try:
-            result = resp['trans_result']
-        except:
-            result=[]
-        for item in result:
-            #output += '' + item['src'] + '\n'
-            output += ' * ' + item['dst'] + '\n'
-        return output
-    
-    
+
+
 #----------------------------------------------------------------------
 # Tecent Translator
 #----------------------------------------------------------------------
+
+# 腾讯云 SDK 导入较慢，首次创建 TecentTranslator 时才加载
+credential = ClientProfile = HttpProfile = None
+TencentCloudSDKException = tmt_client = models = None
+
+def load_tencent_sdk ():
+    global credential, ClientProfile, HttpProfile
+    global TencentCloudSDKException, tmt_client, models
+    if tmt_client is not None:
+        return True
+    from tencentcloud.common import credential
+    from tencentcloud.common.profile.client_profile import ClientProfile
+    from tencentcloud.common.profile.http_profile import HttpProfile
+    from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
+    from tencentcloud.tmt.v20180321 import tmt_client, models
+    return True
+
+
 class TecentTranslator (BasicTranslator):
+
+    # TextTranslate 每次最多 2000 个字符
+    CHUNK_LIMIT = 2000
+    BILLED = True
+
     def __init__ (self, **argv):
         super(TecentTranslator, self).__init__('tecent', **argv)
+        load_tencent_sdk()
         #print(self._config)
         if 'secretid' not in self._config:
-            sys.stderr.write('error: missing SecretId in [tecent] section\n')
-            sys.exit()
+            raise TranslatorError(self._name, 'missing SecretId in [tecent] section')
         if 'secretkey' not in self._config:
-            sys.stderr.write('error: missing SecretKey in [tecent] section\n')
-            sys.exit()
-        self.SecretId = self._config['secretid']
-        self.SecretKey = self._config['secretkey']
+            raise TranslatorError(self._name, 'missing SecretKey in [tecent] section')
+        # 腾讯云使用 ISO 639-1 代码，日语是 ja 不是 jp
         langmap = {
             'zh-cn': 'zh',
             'zh-chs': 'zh',
-            'zh-cht': 'cht',
+            'zh-cht': 'zh-TW',
+            'zh-tw': 'zh-TW',
+            'zh-hk': 'zh-TW',
             'en-us': 'en', 
             'en-gb': 'en',
-            'ja': 'jp',
         }
         self.langmap = langmap
 
@@ -447,43 +2226,352 @@ class TecentTranslator (BasicTranslator):
             return self.langmap[t]
         return lang
 
-    def translate (self, sl, tl, text):
+    @property
+    def SecretId (self):
+        return self._config['secretid']
+
+    @property
+    def SecretKey (self):
+        return self._config['secretkey']
+
+    def _new_client (self):
         httpProfile = HttpProfile()
-        httpProfile.endpoint = "tmt.tencentcloudapi.com"
-        sl, tl = self.guess_language(sl, tl, text)
+        httpProfile.endpoint = self._config.get('endpoint',
+                "tmt.tencentcloudapi.com")
+        httpProfile.scheme = self._config.get('scheme', 'https')
+        httpProfile.keepAlive = True
+        timeout = self._config.get('timeout', 7)
+        if timeout:
+            httpProfile.reqTimeout = int(float(timeout))
+        proxy = self._config.get('proxy', None)
+        if proxy:
+            httpProfile.proxy = proxy
         clientProfile = ClientProfile()
         clientProfile.httpProfile = httpProfile
         cred = credential.Credential(self.SecretId,self.SecretKey)
         # 实例化要请求产品的client对象,clientProfile是可选的
         client = tmt_client.TmtClient(cred, "ap-chengdu", clientProfile)
+        self._keep_alive(client)
+        return client
+
+    # SDK 每次都调用 requests.request()，用完就断开连接；换成连接池里的
+    # Session 发送，复用 TCP 和 TLS 连接。只处理认识的 ProxyConnection
+    def _keep_alive (self, client):
+        conn = getattr(getattr(client, 'request', None), 'conn', None)
+        if conn is None or not hasattr(conn, 'request_host') or \
+                not hasattr(conn, 'certification'):
+            return False
+        session = self._new_session()
+        def request (method, url, body = None, headers = {}):
+            conn.request_length = 0
+            headers.setdefault('Host', conn.request_host)
+            return session.request(method = method, url = url, data = body,
+                    headers = headers, proxies = conn.proxy,
+                    verify = conn.certification, timeout = conn.timeout)
+        conn.request = request
+        # 连接池关闭空闲的 client 时一起关闭 Session
+        client.close = session.close
+        return True
+
+    def _call (self, key, action, req):
+        with self.pooled(key, self._new_client) as client:
+            # client 是复用的，每次请求按当前的自适应超时调整
+            timeout = getattr(_send_local, 'timeout', None)
+            conn = getattr(getattr(client, 'request', None), 'conn', None)
+            if timeout and conn is not None:
+                conn.timeout = timeout
+            _stats_local.engine = self._name
+            with metrics.timer(self._name, 'http'):
+                return getattr(client, action)(req)
 
-        # 实例化一个请求对象,每个接口都会对应一个request对象
-        req = models.TextTranslateRequest()
+    # 腾讯云的限流错误码以 RequestLimitExceeded 开头
+    def classify (self, error):
+        if TencentCloudSDKException is not None:
+            if isinstance(error, TencentCloudSDKException):
+                code = str(getattr(error, 'code', None) or '')
+                if code.startswith('RequestLimitExceeded'):
+                    return 'throttled'
+                if code in ('ClientNetworkError', 'ServerNetworkError',
+                        'InternalError'):
+                    return 'retry'
+                return 'fatal'
+        return super(TecentTranslator, self).classify(error)
+
+    # 返回 [(译文, 源语言, 目标语言)]，多条文本使用 TextTranslateBatch
+    def _translate_batch (self, key, texts):
+        sl, tl = key
+        # client 按密钥和代理放在连接池里复用，配置更新后自然换用新 key
+        pool = (self._name, self.SecretId, self.SecretKey,
+                self._config.get('proxy', None))
+        if len(texts) == 1:
+            # 实例化一个请求对象,每个接口都会对应一个request对象
+            req = models.TextTranslateRequest()
+            params = {
+                "SourceText": texts[0],
+                "Source": self.convert_lang(sl),
+                "Target": self.convert_lang(tl),
+                "ProjectId": 0
+            }
+            req.from_json_string(json.dumps(params))
+            resp = self.send(self._call, pool, 'TextTranslate', req)
+            return [ (resp.TargetText, resp.Source, resp.Target) ]
+        metrics.count(self._name, 'batch.calls')
+        metrics.count(self._name, 'batch.items', len(texts))
+        req = models.TextTranslateBatchRequest()
         params = {
-            "SourceText": text,
-            "Source": 'auto',
-            "Target": 'zh',
+            "SourceTextList": texts,
+            "Source": self.convert_lang(sl),
+            "Target": self.convert_lang(tl),
             "ProjectId": 0
         }
         req.from_json_string(json.dumps(params))
+        resp = self.send(self._call, pool, 'TextTranslateBatch', req)
+        targets = resp.TargetTextList or []
+        if len(targets) != len(texts):
+            output = []
+            for text in texts:
+                output.extend(self._translate_batch(key, [text]))
+            return output
+        return [ (target, resp.Source, resp.Target) for target in targets ]
+
+    def translate (self, sl, tl, text):
+        sl, tl = self.guess_language(sl, tl, text)
+        target, source, dest = self.batched((sl, tl), text,
+                self._translate_batch)
+        res = self.create_translation(source, dest, text)
+        res.translation = target
+        return res
 
-        # 返回的resp是一个TextTranslateResponse的实例，与请求对象对应
-        resp = client.TextTranslate(req)
-        #print(resp)
-        # 输出json格式的字符串回包
 
-        res = {}
-        res['text'] = text
-        res['sl'] = resp.Source
-        res['tl'] = resp.Target
-        res['info'] = None
-        res['translation'] = resp.TargetText
-        res['html'] = None
-        res['xterm'] = None
-        #print(resp.to_json_string())
-        return(res)
 
 
+#----------------------------------------------------------------------
+# 离线词典：预先排好序的索引文件，mmap 后二分查找，不把词典读进内存
+#
+# 索引文件格式（小端）：
+#   头部：magic(8) + 词条数(uint64) + 偏移表位置(uint64)
+#   词条：小写的查找键 + '\0' + 长度(uint32) + 单词\0音标\0释义\0翻译
+#   偏移表：按查找键排序的词条偏移(uint64)
+#----------------------------------------------------------------------
+DICT_MAGIC = b'TRDICT\x00\x01'
+
+class DictIndex (object):
+
+    def __init__ (self, filename):
+        import mmap
+        import struct
+        self._fp = open(filename, 'rb')
+        size = os.fstat(self._fp.fileno()).st_size
+        if size < 24:
+            self._fp.close()
+            raise TranslatorError('local', 'bad dictionary index: ' + filename)
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, count, table = struct.unpack_from('<8sQQ', self._mm, 0)
+        if magic != DICT_MAGIC:
+            self.close()
+            raise TranslatorError('local', 'bad dictionary index: ' + filename)
+        self._count = count
+        self._table = table
+        self._offset = struct.Struct('<Q')
+        self._length = struct.Struct('<I')
+
+    def __len__ (self):
+        return self._count
+
+    def close (self):
+        self._mm.close()
+        self._fp.close()
+
+    def _entry (self, index):
+        offset = self._offset.unpack_from(self._mm, self._table + index * 8)[0]
+        end = self._mm.find(b'\0', offset)
+        return offset, end
+
+    # 二分查找第一个等于 key 的位置
+    def _lower_bound (self, key):
+        mm = self._mm
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, end = self._entry(mid)
+            if mm[offset:end] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _record (self, end):
+        size = self._length.unpack_from(self._mm, end + 1)[0]
+        data = self._mm[end + 5:end + 5 + size].decode('utf-8', 'ignore')
+        return data.split('\0')
+
+    # 返回 (单词, 音标, 释义, 翻译)，大小写不同的词条优先取完全一致的
+    def find (self, word):
+        key = word.strip().lower().encode('utf-8')
+        if not key:
+            return None
+        index = self._lower_bound(key)
+        found = None
+        while index < self._count:
+            offset, end = self._entry(index)
+            if self._mm[offset:end] != key:
+                break
+            record = self._record(end)
+            if found is None or record[0] == word.strip():
+                found = record
+            index += 1
+        return found
+
+
+def _read_ecdict (filename):
+    import csv
+    import io
+    with io.open(filename, 'r', encoding = 'utf-8', newline = '') as fp:
+        reader = csv.reader(fp)
+        header = [ n.strip().lower() for n in next(reader) ]
+        fields = [ header.index(n) if n in header else -1 for n in
+                ('word', 'phonetic', 'definition', 'translation') ]
+        for row in reader:
+            values = [ (i >= 0 and i < len(row)) and row[i] or '' for i in fields ]
+            # ECDICT 用两个字符的 \n 表示换行
+            values[2] = values[2].replace('\\n', '\n')
+            values[3] = values[3].replace('\\n', '\n')
+            yield values
+
+
+# StarDict：读取 .ifo/.idx/.dict（或 .dict.dz）
+def _read_stardict (filename):
+    import gzip
+    import struct
+    base = os.path.splitext(filename)[0]
+    info = {}
+    with _open_text(base + '.ifo') as fp:
+        for line in fp:
+            key, _, val = line.partition('=')
+            info[key.strip()] = val.strip()
+    bits = info.get('idxoffsetbits', '32') == '64' and 'Q' or 'I'
+    types = info.get('sametypesequence', '')
+    if os.path.exists(base + '.dict'):
+        with open(base + '.dict', 'rb') as fp:
+            data = fp.read()
+    else:
+        with gzip.open(base + '.dict.dz', 'rb') as fp:
+            data = fp.read()
+    with open(base + '.idx', 'rb') as fp:
+        index = fp.read()
+    item = struct.Struct('>' + bits + 'I')
+    pos = 0
+    while pos < len(index):
+        end = index.find(b'\0', pos)
+        word = index[pos:end].decode('utf-8', 'ignore')
+        offset, size = item.unpack_from(index, end + 1)
+        pos = end + 1 + item.size
+        text = data[offset:offset + size]
+        if not types and text:
+            # 没有 sametypesequence 时第一个字节是类型
+            text = text[1:].rstrip(b'\0')
+        yield [word, '', '', text.decode('utf-8', 'ignore')]
+
+
+def _open_text (filename):
+    import io
+    return io.open(filename, 'r', encoding = 'utf-8', errors = 'ignore')
+
+
+# 生成索引：词条先顺序写入，内存里只保留 (查找键, 偏移)，最后写排好序的偏移表
+def build_dict_index (source, output):
+    import struct
+    ext = os.path.splitext(source)[1].lower()
+    if ext in ('.ifo', '.idx'):
+        entries = _read_stardict(source)
+    else:
+        entries = _read_ecdict(source)
+    keys = []
+    temp = output + '.tmp'
+    with open(temp, 'wb') as fp:
+        fp.write(struct.pack('<8sQQ', DICT_MAGIC, 0, 0))
+        offset = 24
+        for word, phonetic, definition, translation in entries:
+            key = word.strip().lower().encode('utf-8')
+            if not key or b'\0' in key:
+                continue
+            fields = [word.strip(), phonetic, definition, translation]
+            payload = '\0'.join([ n.replace('\0', '') for n in fields ])
+            payload = payload.encode('utf-8')
+            record = key + b'\0' + struct.pack('<I', len(payload)) + payload
+            fp.write(record)
+            keys.append((key, offset))
+            offset += len(record)
+        keys.sort()
+        fp.write(b''.join([ struct.pack('<Q', n[1]) for n in keys ]))
+        fp.seek(0)
+        fp.write(struct.pack('<8sQQ', DICT_MAGIC, len(keys), offset))
+    if os.path.exists(output):
+        os.remove(output)
+    os.rename(temp, output)
+    return len(keys)
+
+
+class LocalDict (BasicTranslator):
+
+    def __init__ (self, **argv):
+        super(LocalDict, self).__init__('local', **argv)
+        self._index = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def index_path (config):
+        return os.path.expanduser(config.get('index', config_path('dict.tdx')))
+
+    # 没有建立索引时不参与 all/fastest 查询
+    @classmethod
+    def probe (cls):
+        return os.path.exists(cls.index_path(get_config_store().get('local')))
+
+    def get_index (self):
+        with self._lock:
+            if self._index is None:
+                filename = self.index_path(self._config)
+                if not os.path.exists(filename):
+                    raise TranslatorError(self._name, 'missing dictionary '
+                            'index %s, build it with --build-index' % filename)
+                self._index = DictIndex(filename)
+        return self._index
+
+    # 本地查询不需要网络库
+    def preload (self):
+        pass
+
+    # 离线词典不产生费用，未命中时转给的在线引擎自己记录用量
+    def billed (self):
+        return False
+
+    # mmap 查找比 sqlite 缓存还快，不需要再缓存
+    def _cache_enabled (self):
+        return False
+
+    # 词典里只有单词和短语
+    def supports (self, text):
+        return len(text.split()) <= 3 and self.probe()
+
+    def translate (self, sl, tl, text):
+        record = self.get_index().find(text)
+        if record is None:
+            # 未命中时交给在线引擎，默认是必应，fallback = no 时关闭
+            fallback = self._config.get('fallback', 'bing')
+            if not getattr(_fallback_local, 'enabled', True):
+                return None
+            if fallback in ENGINES and fallback != 'local':
+                return get_translator(fallback).lookup(sl, tl, text)
+            return None
+        word, phonetic, definition, translation = record
+        res = self.create_translation(sl, tl, text)
+        res.phonetic = phonetic or None
+        res.definition = definition or None
+        res.explain = [ n.strip() for n in translation.split('\n')
+                if n.strip() ]
+        return res
+
 
 
 #----------------------------------------------------------------------
@@ -522,69 +2610,1096 @@ ENGINES = {
     'tecent': TecentTranslator,
     #'youdao': YoudaoTranslator,
     'bing': BingDict,
+    'local': LocalDict,
 }
 
+
+# all/fastest 默认使用的引擎：跳过 probe() 返回假（比如没有配置）的引擎
+def default_engines ():
+    names = []
+    for name, cls in ENGINES.items():
+        probe = getattr(cls, 'probe', None)
+        if probe is None or probe():
+            names.append(name)
+    return names
+
+
+#----------------------------------------------------------------------
+# 引擎实例：进程内复用，保持会话和网络连接
+#----------------------------------------------------------------------
+_translator_lock = threading.Lock()
+_translator_locks = {}
+_translator_errors = {}
+_translators = {}
+
+# 引擎依赖的第三方库只在首次创建实例时导入，缺失时抛出 ImportError，
+# 缺少密钥等配置时抛出 TranslatorError。每个引擎单独加锁，构造时导入
+# 第三方库不会挡住其它引擎；依赖缺失在进程内不会恢复，记下来直接抛出
+def get_translator (name):
+    translator = _translators.get(name)
+    if translator is not None:
+        return translator
+    with _translator_lock:
+        lock = _translator_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name in _translator_errors:
+            raise _translator_errors[name]
+        translator = _translators.get(name)
+        if translator is None:
+            try:
+                translator = ENGINES[name]()
+            except ImportError as e:
+                _translator_errors[name] = e
+                raise
+            _translators[name] = translator
+    return translator
+
+
+# all/fastest 分发前在当前线程创建引擎并导入依赖，工作线程里不再有
+# 首次导入，避免各自持有导入锁互相等待；创建失败的引擎由 run_engine 报告
+def prepare_engines (names):
+    for name in names:
+        try:
+            get_translator(name).preload()
+        except Exception:
+            pass
+
+
+# 命令行使用：创建失败时输出错误信息并返回 None
+def load_engine (name):
+    try:
+        return get_translator(name)
+    except ImportError as e:
+        sys.stderr.write('error: %s engine unavailable: %s\n' % (name, e))
+    except TranslatorError as e:
+        sys.stderr.write('error: %s\n' % e)
+    return None
+
+
 #----------------------------------------------------------------------
 # 处理输出
 #----------------------------------------------------------------------
 
 
-def print_res(res, text, options):
+def print_res(res, text, options, fp = None):
+    if fp is None:
+        fp = sys.stdout
+    engine = res and res.engine or 'unknown'
+    with metrics.timer(engine, 'render'):
+        return _print_res(res, text, options, fp)
+
+
+def _print_res(res, text, options, fp):
     if 'json' in options:
-        text = json.dumps(res)
-        sys.stdout.write(str(text))
+        write_json(res and res.to_dict(), fp)
         return 0
     if not res:
         return -2
-    #if 'text' in res:
-        #if res['text']:
-            #print(res['text'])
-    if 'phonetic' in res:
-        if res['phonetic'] and ('phonetic' in options):
-            print('[' + res['phonetic'] + ']')
-    if 'definition' in res:
-        if res['definition']:
-            print(res['definition'])
-    if 'explain' in res:
-        if res['explain']:
-            print('\n'.join(res['explain']))
-    elif 'translation' in res:
-        if res['translation']:
-            print(res['translation'])
-    if 'alternative' in res:
-        if res['alternative']:
-            print('\n'.join(res['alternative']))
-
-
-#----------------------------------------------------------------------
-# 多线程翻译
-#----------------------------------------------------------------------
-class TransThread(threading.Thread):
-    def __init__(self, sl, tl, text, engine, options):
-        super().__init__()
-        self.sl = sl
-        self.tl = tl
-        self.text = text
-        self.engine = engine
-        self.options = options
+    if res.phonetic and ('phonetic' in options):
+        print('[' + res.phonetic + ']', file = fp)
+    if res.definition:
+        print(res.definition, file = fp)
+    if res.explain:
+        print('\n'.join(res.explain), file = fp)
+    elif res.translation:
+        print(res.translation, file = fp)
+    if res.alternative:
+        print('\n'.join(res.alternative), file = fp)
+
+
+#----------------------------------------------------------------------
+# 多引擎并发翻译：全局截止时间加上各引擎自己的截止时间
+#----------------------------------------------------------------------
+class Outcome (object):
+
+    def __init__ (self, engine, status, result = None, error = None,
+            elapsed = 0.0):
+        self.engine = engine        # 引擎名称
+        self.status = status        # ok/error/timeout/unavailable/busy
+        self.result = result        # 翻译结果
+        self.error = error          # 异常
+        self.elapsed = elapsed      # 耗时（秒）
+
+    def as_dict (self):
+        res = {}
+        res['engine'] = self.engine
+        res['status'] = self.status
+        res['error'] = self.error is not None and str(self.error) or None
+        res['elapsed'] = round(self.elapsed, 3)
+        res['result'] = self.result and self.result.to_dict()
+        return res
+
+
+# all/fastest/auto 会同时或依次查询其它引擎，离线词典未命中时不再转给
+# 在线引擎，避免同一个引擎被查询两次
+_fallback_local = threading.local()
+
+def run_engine (name, sl, tl, text, options, notify = None,
+        fallback = True):
+    start = time.time()
+    _fallback_local.enabled = fallback
+    try:
+        translator = get_translator(name)
+        if notify is not None:
+            notify(name, translator._config.get('deadline'))
+        res = translator.lookup(sl, tl, text, 'no-cache' not in options,
+                'refresh' in options, 'raw' in options)
+    except ImportError as e:
+        return Outcome(name, 'unavailable', None, e, time.time() - start)
+    except TranslatorError as e:
+        status = e.kind == 'open' and 'unavailable' or 'error'
+        return Outcome(name, status, None, e, time.time() - start)
+    except Exception as e:
+        return Outcome(name, 'error', None, e, time.time() - start)
+    finally:
+        _fallback_local.enabled = True
+    return Outcome(name, 'ok', res, None, time.time() - start)
+
+
+# 引擎最近的 p50 网络延迟，用来决定对冲请求的等待时间；数据来自
+# health.json，每次单独启动的命令行（比如 GoldenDict）也能用上
+def engine_p50 (name):
+    try:
+        key = get_translator(name)._name
+    except Exception:
+        return None
+    return get_health().summary(key)[0]
+
+
+# 各引擎的查询交给调度器的交互通道，超过截止时间的引擎记为 timeout，
+# 不再等待也不会阻塞进程退出；排不上队的引擎记为 busy；
+# 每个引擎有结论时调用 callback
+def dispatch (names, sl, tl, text, options, deadline = 10.0, callback = None):
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue    # noqa: F821
+    events = queue.Queue()
+    start = time.time()
+    deadlines = dict([ (name, start + deadline) for name in names ])
+    def notify (name, limit):
+        if limit:
+            events.put(('deadline', name, start + float(limit)))
+    def work (name):
+        events.put(('done', name, run_engine(name, sl, tl, text, options,
+            notify, False)))
+    outcomes = {}
+    def finish (outcome):
+        outcomes[outcome.engine] = outcome
+        if callback is not None:
+            callback(outcome)
+    prepare_engines(names)
+    dispatcher = get_dispatcher()
+    for name in names:
+        try:
+            dispatcher.submit(name, Dispatcher.INTERACTIVE, work, (name,),
+                    start + deadline)
+        except Busy as e:
+            finish(Outcome(name, 'busy', None, e, time.time() - start))
+    while len(outcomes) < len(names):
+        now = time.time()
+        for name in names:
+            if name not in outcomes and deadlines[name] <= now:
+                finish(Outcome(name, 'timeout', None, None, now - start))
+        pending = [ deadlines[n] for n in names if n not in outcomes ]
+        if not pending:
+            break
+        try:
+            kind, name, value = events.get(timeout = max(0, min(pending) - now))
+        except queue.Empty:
+            continue
+        if name in outcomes:
+            continue
+        if kind == 'deadline':
+            deadlines[name] = min(deadlines[name], value)
+        else:
+            finish(value)
+    return [ outcomes[name] for name in names ]
+
+
+# 有译文才算有效结果，比如必应查不了句子时返回的是空结果
+def valid_outcome (outcome):
+    if outcome.status != 'ok' or not outcome.result:
+        return False
+    return bool(get_translator(outcome.engine).result_text(outcome.result))
+
+
+# 对冲请求：返回最先到达的有效结果，其余的结果直接丢弃。
+# hedge 为真时按顺序逐个启动，前一个引擎超过它的 p50 延迟
+# （没有统计数据时用 delay）还没返回或者失败了，才启动下一个
+def race (names, sl, tl, text, options, deadline = 10.0, hedge = False,
+        delay = 0.5):
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue    # noqa: F821
+    events = queue.Queue()
+    start = time.time()
+    def work (name):
+        events.put(run_engine(name, sl, tl, text, options, None, False))
+    pending = list(names)
+    state = {'running': 0, 'next': start}
+    prepare_engines(names)
+    dispatcher = get_dispatcher()
+    def launch ():
+        name = pending.pop(0)
+        try:
+            dispatcher.submit(name, Dispatcher.INTERACTIVE, work, (name,),
+                    start + deadline)
+        except Busy as e:
+            events.put(Outcome(name, 'busy', None, e, time.time() - start))
+        state['running'] += 1
+        wait = engine_p50(name)
+        state['next'] = time.time() + (wait is None and delay or wait)
+    if hedge:
+        launch()
+    else:
+        while pending:
+            launch()
+    last = None
+    while state['running'] > 0 or pending:
+        now = time.time()
+        if now >= start + deadline:
+            break
+        if pending and (state['running'] == 0 or now >= state['next']):
+            launch()
+            continue
+        wait = start + deadline - now
+        if pending:
+            wait = min(wait, state['next'] - now)
+        try:
+            outcome = events.get(timeout = max(0, wait))
+        except queue.Empty:
+            continue
+        state['running'] -= 1
+        if valid_outcome(outcome):
+            return outcome
+        last = outcome
+    if last is not None and state['running'] == 0 and not pending:
+        return last
+    return Outcome('fastest', 'timeout', None, None, time.time() - start)
+
+
+#----------------------------------------------------------------------
+# 自动路由：按配额、延迟、成功率和费用给每个请求选一个引擎，
+# 出错或者没有结果时再依次尝试后面的引擎
+#----------------------------------------------------------------------
+def route_plan (names, text, config):
+    health = get_health()
+    usage = get_usage()
+    target = float(config.get('latency_target', 2.0))
+    minimum = float(config.get('min_success', 0.8))
+    preferred = []
+    fallback = []
+    for rank, name in enumerate(names):
+        try:
+            translator = get_translator(name)
+        except Exception:
+            continue
+        if not translator.supports(text):
+            continue
+        key = translator._name
+        engine = translator._config
+        if not health.available(key, engine):
+            continue
+        # 超出本月配额的引擎不再使用，请求溢出到其它引擎
+        quota = int(float(engine.get('quota', 0)))
+        if quota > 0 and usage.get(key) + len(text) > quota:
+            continue
+        cost = float(engine.get('cost', 0))
+        p50, p95, rate = health.summary(key)
+        if (p95 is None or p95 <= target) and (rate is None or
+                rate >= minimum):
+            preferred.append(((cost, p50 or target, rank), name))
+        else:
+            fallback.append(((p95 or target, cost, rank), name))
+    return [ n for _, n in sorted(preferred) + sorted(fallback) ]
+
+
+def route (names, sl, tl, text, options, config):
+    start = time.time()
+    last = None
+    for name in route_plan(names, text, config):
+        outcome = run_engine(name, sl, tl, text, options, None, False)
+        if valid_outcome(outcome):
+            return outcome
+        last = outcome
+    if last is None:
+        error = TranslatorError('auto', 'no engine can handle this request')
+        return Outcome('auto', 'unavailable', None, error,
+                time.time() - start)
+    return last
+
+
+def print_usage (fp):
+    usage = get_usage()
+    store = get_config_store()
+    print('usage of %s:' % usage.month(), file = fp)
+    for name, count in sorted(usage.snapshot().items()):
+        quota = int(float(store.get(name).get('quota', 0)))
+        line = '  %-10s %10d chars' % (name, count)
+        if quota > 0:
+            line += '  quota %d (%.1f%%)' % (quota, count * 100.0 / quota)
+        print(line, file = fp)
+    return 0
+
+
+# fastest/auto 只输出一个结果
+def print_single (outcome, text, options, fp):
+    if 'ndjson' in options:
+        RecordWriter(fp).write(outcome.as_dict())
+        return outcome.status == 'ok' and 0 or -1
+    if 'json' in options:
+        write_json(outcome.as_dict(), fp)
+    elif outcome.status == 'ok':
+        print_res(outcome.result, text, options, fp)
+    else:
+        sys.stderr.write('error: %s\n' % (outcome.error or outcome.status))
+        return -1
+    return 0
+
+
+def print_outcome (outcome, text, options, fp):
+    if 'json' in options:
+        if outcome.status == 'ok':
+            return print_res(outcome.result, text, options, fp)
+        write_json(outcome.as_dict(), fp)
+        return 0
+    print("----------------------------------------------------------------------", file = fp)
+    print(ENGINES[outcome.engine].__name__, file = fp)
+    print("----------------------------------------------------------------------", file = fp)
+    if outcome.status == 'ok':
+        return print_res(outcome.result, text, options, fp)
+    if outcome.status == 'timeout':
+        print('(timeout after %.1fs)' % outcome.elapsed, file = fp)
+    else:
+        print('(%s: %s)' % (outcome.status, outcome.error), file = fp)
+    return -1
+
+
+#----------------------------------------------------------------------
+# NDJSON 流式输出：每条结果一行，序列化后一次写入并立即刷新，
+# 多个线程同时完成时也不会交错
+#----------------------------------------------------------------------
+class RecordWriter (object):
+
+    def __init__ (self, fp):
+        self._fp = fp
+        self._lock = threading.Lock()
+
+    def write (self, record, **extra):
+        record.update(extra)
+        with self._lock:
+            write_json(record, self._fp, True)
+            self._fp.flush()
+
+
+#----------------------------------------------------------------------
+# 批量翻译：逐行或逐段读取，限制并发请求数，按输入顺序输出
+#----------------------------------------------------------------------
+def read_segments (fp, paragraph = False):
+    if not paragraph:
+        for line in fp:
+            yield line.rstrip('\r\n')
+        return
+    lines = []
+    for line in fp:
+        line = line.rstrip('\r\n')
+        if line.strip():
+            lines.append(line)
+        elif lines:
+            yield '\n'.join(lines)
+            lines = []
+    if lines:
+        yield '\n'.join(lines)
+
+
+# 翻译记忆：--tm 或配置 tm = yes 时启用，--tm=0.8 可以临时调整阈值
+def memory_options (translator, options):
+    config = translator._config
+    if 'tm' not in options:
+        if config.get('tm', 'no').lower() not in ('1', 'yes', 'true', 'on'):
+            return None
+    return float(options.get('tm') or config.get('tm_threshold', 0.9))
+
+
+def memory_lookup (translator, sl, tl, text, options, threshold = None):
+    cache = 'no-cache' not in options
+    refresh = 'refresh' in options
+    raw = 'raw' in options
+    if threshold is None or refresh:
+        return translator.lookup(sl, tl, text, cache, refresh, raw)
+    memory = get_memory()
+    ksl, ktl = translator.key_langs(sl, tl, text)
+    match = memory.find(translator._name, ksl, ktl, text)
+    if match is not None:
+        metrics.count(translator._name, 'tm.hit')
+        output, source = match
+        res = translator.create_translation(sl, tl, text)
+        res.translation = output
+        res.tm = {'status': 'hit', 'source': source}
+        return res
+    metrics.count(translator._name, 'tm.miss')
+    res = translator.lookup(sl, tl, text, cache, refresh, raw)
+    output = translator.result_text(res)
+    if output:
+        memory.add(translator._name, ksl, ktl, text, output)
+    if res:
+        res.tm = {'status': 'miss'}
+        # 相近句子的译文只在 JSON 输出里作为参考
+        if 'json' in options or 'ndjson' in options:
+            found = memory.suggest(translator._name, ksl, ktl, text,
+                    threshold)
+            if found:
+                res.tm['suggestions'] = [ {'score': round(score, 4),
+                    'source': source, 'target': target}
+                    for score, source, target in found ]
+    return res
+
+
+def write_batch_result (translator, text, future, options, fp):
+    try:
+        res = future.result()
+    except Exception as e:
+        sys.stderr.write('error: %s: %s\n' % (text[:40], e))
+        res = None
+    if 'json' in options:
+        write_json(res and res.to_dict(), fp, True)
+    else:
+        output = translator.result_text(res)
+        fp.write(output + (('paragraph' in options) and '\n\n' or '\n'))
+    fp.flush()
+
+
+# 同一个引擎实例（同一个连接池）在调度器的批量通道里最多 jobs 个并发，
+# 已提交但未输出的任务最多 jobs * 2 个，内存占用和输入大小无关
+def batch_translate (translator, sl, tl, segments, options, fp, jobs = 4):
+    import collections
+    threshold = memory_options(translator, options)
+    writer = 'ndjson' in options and RecordWriter(fp) or None
+    def work (text):
+        if not text.strip():
+            return None
+        return memory_lookup(translator, sl, tl, text, options, threshold)
+    # --ndjson：每行完成后立即输出一条记录，用 index 对应输入的行号
+    def stream (index, text):
+        start = time.time()
+        try:
+            res = work(text)
+        except Exception as e:
+            outcome = Outcome(translator._name, 'error', None, e,
+                    time.time() - start)
+        else:
+            outcome = Outcome(translator._name, res and 'ok' or 'empty', res,
+                    None, time.time() - start)
+        writer.write(outcome.as_dict(), index = index)
+    def finish (text, future):
+        if writer is None:
+            write_batch_result(translator, text, future, options, fp)
+        else:
+            future.result()
+    pending = collections.deque()
+    executor = get_dispatcher().executor(translator._name, jobs)
+    for index, text in enumerate(segments):
+        if writer is None:
+            future = executor.submit(work, text)
+        else:
+            future = executor.submit(stream, index, text)
+        pending.append((text, future))
+        while pending and (pending[0][1].done() or len(pending) >= jobs * 2):
+            finish(*pending.popleft())
+    while pending:
+        finish(*pending.popleft())
+    return 0
+
+
+def run_batch (engine, sl, tl, options, fp):
+    if engine not in ENGINES:
+        print('batch mode needs a single engine: --engine=' + '|'.join(ENGINES),
+                file = fp)
+        return -1
+    translator = load_engine(engine)
+    if translator is None:
+        return -1
+    jobs = max(1, int(options.get('jobs') or 4))
+    paragraph = 'paragraph' in options
+    filename = options.get('batch')
+    if not filename or filename == '-':
+        segments = read_segments(sys.stdin, paragraph)
+        return batch_translate(translator, sl, tl, segments, options, fp, jobs)
+    with codecs.open(filename, 'r', 'utf-8') as infile:
+        segments = read_segments(infile, paragraph)
+        return batch_translate(translator, sl, tl, segments, options, fp, jobs)
+
+
+#----------------------------------------------------------------------
+# 文档翻译：按段落和句子切分成不超过引擎上限的块，并发翻译后按原顺序拼接
+#----------------------------------------------------------------------
+_PARAGRAPH = re.compile(r'(\n[ \t]*\n\s*)')
+_SENTENCE_END = re.compile(
+        r'[.!?;]+[\'"\u201d\u2019)]*(?:\s+|$)|'
+        r'[\u3002\uff01\uff1f\uff1b]+[\u201d\u2019\uff09]*\s*|\n')
+
+def split_sentences (text):
+    pieces = []
+    start = 0
+    for m in _SENTENCE_END.finditer(text):
+        if m.end() > start:
+            pieces.append(text[start:m.end()])
+            start = m.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+# 超长的句子只能硬切
+def split_hard (text, limit, measure):
+    pieces = []
+    while measure(text) > limit:
+        size = min(len(text), limit)
+        while size > 1 and measure(text[:size]) > limit:
+            size = size * 3 // 4
+        # 尽量在空白处断开，不要切断单词
+        space = max(text.rfind(' ', 0, size), text.rfind('\n', 0, size))
+        if space > 0:
+            size = space + 1
+        pieces.append(text[:size])
+        text = text[size:]
+    pieces.append(text)
+    return pieces
+
+
+def pack_chunks (pieces, limit, measure):
+    chunks = []
+    current = ''
+    for piece in pieces:
+        for part in split_hard(piece, limit, measure):
+            if current and measure(current + part) > limit:
+                chunks.append(current)
+                current = ''
+            current += part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# 返回 [(是否需要翻译, 文本)]，空白部分原样保留，拼接后和原文完全一致
+def split_document (text, limit, measure):
+    pieces = []
+    for index, block in enumerate(_PARAGRAPH.split(text)):
+        if index % 2 == 1 or not block.strip():
+            pieces.append((False, block))
+            continue
+        if measure(block) <= limit:
+            chunks = [block]
+        else:
+            chunks = pack_chunks(split_sentences(block), limit, measure)
+        for chunk in chunks:
+            body = chunk.strip()
+            # 只有空白的块（比如行尾的两个空格）原样保留，不发给引擎
+            if not body:
+                pieces.append((False, chunk))
+                continue
+            head = chunk[:len(chunk) - len(chunk.lstrip())]
+            tail = chunk[len(chunk.rstrip()):]
+            if head:
+                pieces.append((False, head))
+            pieces.append((True, body))
+            if tail:
+                pieces.append((False, tail))
+    return pieces
+
+
+def translate_document (translator, sl, tl, text, options):
+    pieces = split_document(text, translator.chunk_limit(), translator.measure)
+    threshold = memory_options(translator, options)
+    def work (chunk):
+        res = memory_lookup(translator, sl, tl, chunk, options, threshold)
+        return translator.result_text(res)
+    chunks = [ piece for needed, piece in pieces if needed ]
+    concurrency = max(1, int(translator._config.get('concurrency', 4)))
+    executor = get_dispatcher().executor(translator._name, concurrency)
+    results = iter(executor.map(work, chunks))
+    output = []
+    for needed, piece in pieces:
+        output.append(next(results) if needed else piece)
+    return ''.join(output), len(chunks)
+
+
+def run_document (engine, sl, tl, args, options, fp):
+    if engine not in ENGINES:
+        print('document mode needs a single engine: --engine=' +
+                '|'.join(ENGINES), file = fp)
+        return -1
+    translator = load_engine(engine)
+    if translator is None:
+        return -1
+    if translator.chunk_limit() <= 0:
+        sys.stderr.write('error: %s does not support documents\n' % engine)
+        return -1
+    filename = options.get('doc')
+    if args:
+        text = ' '.join(args)
+    elif filename and filename != '-':
+        with codecs.open(filename, 'r', 'utf-8') as infile:
+            text = infile.read()
+    else:
+        text = sys.stdin.read()
+    start = time.time()
+    try:
+        output, count = translate_document(translator, sl, tl, text, options)
+    except TranslatorError as e:
+        sys.stderr.write('error: %s\n' % e)
+        return -1
+    if 'json' in options:
+        res = {'engine': engine, 'text': text, 'translation': output,
+               'chunks': count, 'elapsed': round(time.time() - start, 3)}
+        write_json(res, fp, True)
+    else:
+        fp.write(output)
+        if not output.endswith('\n'):
+            fp.write('\n')
+    return 0
+
+
+#----------------------------------------------------------------------
+# 语料翻译任务：翻译整个目录树，每完成一段追加一行到日志，
+# 中断后重新运行同样的命令，日志里已有的段落不会再次请求
+#----------------------------------------------------------------------
+class Journal (object):
 
-    def run(self):
-        translator = self.engine()
-        res = translator.translate(self.sl, self.tl, self.text)
-        print("----------------------------------------------------------------------")
-        print(self.engine.__name__)
-        print("----------------------------------------------------------------------")
-        print_res(res, self.text.strip(), self.options)
+    def __init__ (self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._done = {}
+        self._fp = None
+
+    def make_key (self, engine, sl, tl, text):
+        data = '\0'.join((engine, sl or '', tl or '', text))
+        import hashlib
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    # 进程崩溃时最后一行可能不完整，解析失败的行直接跳过
+    def load (self):
+        if not os.path.exists(self._filename):
+            return 0
+        with codecs.open(self._filename, 'r', 'utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                    self._done[record['key']] = record['output']
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return len(self._done)
+
+    def get (self, key):
+        return self._done.get(key)
+
+    def append (self, key, output, **extra):
+        record = {'key': key, 'output': output}
+        record.update(extra)
+        data = json.dumps(record) + '\n'
+        with self._lock:
+            if self._fp is None:
+                dirname = os.path.dirname(self._filename)
+                if dirname and not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                self._fp = codecs.open(self._filename, 'a', 'utf-8')
+            self._fp.write(data)
+            self._fp.flush()
+            self._done[key] = output
+
+    def close (self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+# 参数可以是文件、目录或者通配符（** 匹配多级目录）；
+# exclude 里的文件和目录（比如输出目录和日志）不作为输入
+def expand_files (patterns, exclude = ()):
+    import glob
+    skip = [ os.path.realpath(n) for n in exclude ]
+    def excluded (path):
+        path = os.path.realpath(path)
+        for n in skip:
+            if path == n or path.startswith(n.rstrip(os.sep) + os.sep):
+                return True
+        return False
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs[:] = sorted([ n for n in dirs
+                    if not excluded(os.path.join(root, n)) ])
+                files.extend([ os.path.join(root, n) for n in sorted(names) ])
+        else:
+            files.extend(sorted(glob.glob(pattern, recursive = True)))
+    seen = set()
+    output = []
+    for name in files:
+        path = os.path.normpath(name)
+        if os.path.isfile(path) and path not in seen and not excluded(path):
+            seen.add(path)
+            output.append(path)
+    return output
+
+
+class JobFile (object):
+
+    def __init__ (self, source, target, pieces):
+        self.source = source
+        self.target = target
+        self.pieces = pieces
+        self.futures = {}
+        self.resumed = 0
+
+    def done (self):
+        return all([ f.done() for f in self.futures.values() ])
+
+    def segments (self):
+        return len([ 1 for needed, piece in self.pieces if needed ])
+
+
+def write_job_file (job, fp):
+    output = []
+    failed = None
+    for index, (needed, piece) in enumerate(job.pieces):
+        if not needed:
+            output.append(piece)
+            continue
+        future = job.futures.get(index)
+        if future is None:
+            output.append(piece)
+            continue
+        try:
+            output.append(future.result())
+        except Exception as e:
+            failed = e
+    if failed is not None:
+        print('failed %s: %s' % (job.source, failed), file = fp)
+        return False
+    dirname = os.path.dirname(job.target)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    temp = job.target + '.tmp'
+    with codecs.open(temp, 'w', 'utf-8') as outfile:
+        outfile.write(''.join(output))
+    os.replace(temp, job.target)
+    print('ok     %s -> %s (%d segments, %d from journal)' % (job.source,
+        job.target, job.segments(), job.resumed), file = fp)
+    return True
+
+
+def run_job (engine, sl, tl, args, options, fp):
+    from concurrent.futures import Future
+    if engine not in ENGINES:
+        print('job mode needs a single engine: --engine=' +
+                '|'.join(ENGINES), file = fp)
+        return -1
+    outdir = options.get('output')
+    if not outdir or not args:
+        print('usage: translator.py --engine=xx --job{=journal} '
+                '--output=dir {--jobs=n} files|dirs|globs', file = fp)
+        return -1
+    translator = load_engine(engine)
+    if translator is None:
+        return -1
+    if translator.chunk_limit() <= 0:
+        sys.stderr.write('error: %s does not support documents\n' % engine)
+        return -1
+    outdir = os.path.expanduser(outdir)
+    filename = options.get('job') or os.path.join(outdir, '.journal.jsonl')
+    # 重新运行时输出目录可能在输入目录里面，译文和日志不能再被翻译
+    files = expand_files(args, (outdir, filename))
+    if not files:
+        sys.stderr.write('error: no input files\n')
+        return -1
+    base = os.path.commonpath([ os.path.abspath(os.path.dirname(n))
+        for n in files ])
+    journal = Journal(filename)
+    journal.load()
+    jobs = max(1, int(options.get('jobs') or 4))
+    threshold = memory_options(translator, options)
+    def work (key, source, index, text):
+        res = memory_lookup(translator, sl, tl, text, options, threshold)
+        output = translator.result_text(res)
+        journal.append(key, output, file = source, index = index)
+        return output
+    pending = []
+    results = {'ok': 0, 'failed': 0}
+    def finish (job):
+        for future in job.futures.values():
+            future.exception()
+        results[write_job_file(job, fp) and 'ok' or 'failed'] += 1
+    executor = get_dispatcher().executor(translator._name, jobs)
+    try:
+        for source in files:
+            target = os.path.join(outdir,
+                    os.path.relpath(os.path.abspath(source), base))
+            try:
+                with codecs.open(source, 'r', 'utf-8') as infile:
+                    text = infile.read()
+            except (IOError, OSError, UnicodeError) as e:
+                print('failed %s: %s' % (source, e), file = fp)
+                results['failed'] += 1
+                continue
+            pieces = split_document(text, translator.chunk_limit(),
+                    translator.measure)
+            job = JobFile(source, target, pieces)
+            for index, (needed, piece) in enumerate(pieces):
+                if not needed:
+                    continue
+                key = journal.make_key(engine, sl, tl, piece)
+                output = journal.get(key)
+                if output is not None:
+                    future = Future()
+                    future.set_result(output)
+                    job.resumed += 1
+                else:
+                    future = executor.submit(work, key, source, index,
+                            piece)
+                job.futures[index] = future
+            pending.append(job)
+            # 未完成的段落过多时先等最早的文件完成，内存占用有上限
+            while len(pending) > 1 and (pending[0].done() or
+                    sum([ len(j.futures) for j in pending ]) > jobs * 8):
+                finish(pending.pop(0))
+        while pending:
+            finish(pending.pop(0))
+    finally:
+        journal.close()
+    print('%d files translated, %d failed' % (results['ok'],
+        results['failed']), file = fp)
+    return results['failed'] and -1 or 0
+
+
+#----------------------------------------------------------------------
+# 常驻服务：保持引擎实例、会话和连接，客户端通过本地端口转发命令行
+#----------------------------------------------------------------------
+DEFAULT_SERVER = '127.0.0.1:8756'
+
+# 读取标准输入或本地文件的模式：客户端不转发，服务端也拒绝执行
+LOCAL_MODES = ('batch', 'doc', 'job', 'build-index')
+
+def parse_address (text):
+    host, _, port = (text or DEFAULT_SERVER).rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def make_server (address):
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver    # noqa: F821
+
+    class TranslatorHandler (socketserver.StreamRequestHandler):
+
+        def handle (self):
+            line = self.rfile.readline()
+            try:
+                argv = json.loads(line.decode('utf-8'))['argv']
+                argv = [ str(n) for n in argv ]
+                options, args = getopt(argv)
+            except (ValueError, KeyError, TypeError):
+                return
+            local = [ n for n in LOCAL_MODES if n in options ]
+            if local:
+                reply = {'code': -1, 'output': '', 'error': 'error: '
+                        '--%s must run locally\n' % local[0]}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                return
+            # 转发的参数里不允许再启动服务或者转发给自己
+            head = argv[:len(argv) - len(args)]
+            argv = [ n for n in head if n.lstrip('-').partition('=')[0]
+                    .strip() not in ('serve', 'client') ] + args
+            # 同时处理的连接数有上限，超出时立即回复 busy
+            if not self.server.slots.acquire(False):
+                reply = {'code': -1, 'output': 'error: server busy\n'}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                return
+            try:
+                self.process(argv)
+            finally:
+                self.server.slots.release()
+
+        def process (self, argv):
+            import io
+            fp = io.StringIO()
+            err = io.StringIO()
+            if '--ndjson' in argv:
+                lock = threading.Lock()
+                fp = StreamReply(self.wfile, 'output', lock)
+                err = StreamReply(self.wfile, 'error', lock)
+            # 本线程写到 stderr 的错误信息随回复返回给客户端
+            stderr = sys.stderr
+            if isinstance(stderr, ThreadStderr):
+                stderr.redirect(err)
+            try:
+                code = main(['translator.py'] + argv, fp)
+            except SystemExit as e:
+                code = isinstance(e.code, int) and e.code or -1
+            except Exception as e:
+                err.write('error: %s\n' % e)
+                code = -1
+            finally:
+                if isinstance(stderr, ThreadStderr):
+                    stderr.redirect(None)
+            reply = {'code': code or 0, 'output': '', 'error': ''}
+            if not isinstance(fp, StreamReply):
+                reply['output'] = fp.getvalue()
+                reply['error'] = err.getvalue()
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+    class TranslatorServer (socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = TranslatorServer(address, TranslatorHandler)
+    if not isinstance(sys.stderr, ThreadStderr):
+        sys.stderr = ThreadStderr(sys.stderr)
+    config = get_config_store().get('default')
+    server.slots = threading.BoundedSemaphore(int(config.get('max_clients',
+        64)))
+    return server
+
+
+# --ndjson 时服务端把每次写入立即转发给客户端，最后一行才带 code；
+# key 为 output 或 error，区分客户端的 stdout 和 stderr
+class StreamReply (object):
+
+    def __init__ (self, wfile, key = 'output', lock = None):
+        self._wfile = wfile
+        self._key = key
+        self._lock = lock or threading.Lock()
+
+    def write (self, data):
+        if data:
+            line = json.dumps({self._key: data}).encode('utf-8') + b'\n'
+            with self._lock:
+                self._wfile.write(line)
+                self._wfile.flush()
+
+    def flush (self):
+        pass
+
+
+# 常驻服务里替换 sys.stderr：处理连接的线程写入各自的回复，
+# 其它线程照常写到原来的 stderr
+class ThreadStderr (object):
+
+    def __init__ (self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def redirect (self, fp):
+        self._local.fp = fp
+
+    def _target (self):
+        return getattr(self._local, 'fp', None) or self._stream
+
+    def write (self, data):
+        return self._target().write(data)
+
+    def flush (self):
+        return self._target().flush()
+
+    def __getattr__ (self, name):
+        return getattr(self._stream, name)
+
+
+def serve (address):
+    server = make_server(address)
+    sys.stderr.write('serving on %s:%d\n' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+# 转发给常驻服务，服务不可用时返回 None
+def run_client (address, argv, fp, timeout = 30):
+    import socket
+    data = json.dumps({'argv': argv}).encode('utf-8') + b'\n'
+    try:
+        sock = socket.create_connection(address, timeout)
+    except (socket.error, socket.timeout):
+        return None
+    written = False
+    try:
+        sock.sendall(data)
+        rfile = sock.makefile('rb')
+        while True:
+            line = rfile.readline()
+            try:
+                reply = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # 已经输出了部分结果，不能再回退到本地执行
+                return written and -1 or None
+            fp.write(reply.get('output', ''))
+            if reply.get('error'):
+                sys.stderr.write(reply['error'])
+                sys.stderr.flush()
+            written = written or bool(reply.get('output') or
+                    reply.get('error'))
+            if 'code' in reply:
+                return reply['code']
+            fp.flush()
+    except (socket.error, socket.timeout):
+        return written and -1 or None
+    finally:
+        sock.close()
 
 
 #----------------------------------------------------------------------
 # 主程序
 #----------------------------------------------------------------------
-def main(argv = None):
+def main(argv = None, fp = None):
     if argv is None:
         argv = sys.argv
+    if fp is None:
+        fp = sys.stdout
     argv = [ n for n in argv ]
     options, args = getopt(argv[1:])
+    if 'serve' in options:
+        return serve(parse_address(options['serve']))
+    # 读取标准输入或本地文件的模式不转发，在本地执行
+    local = [ n for n in LOCAL_MODES if n in options ]
+    if 'client' in options and not local:
+        forward = [ n for n in argv[1:] if not n.startswith('--client') ]
+        code = run_client(parse_address(options['client']), forward, fp)
+        if code is not None:
+            return code
+    install_stats_hook(get_config_store().get('default'))
+    try:
+        return execute(options, args, fp)
+    finally:
+        if 'stats' in options:
+            # 写到 stderr，服务端运行时由 ThreadStderr 放进回复的 error 字段
+            print_stats(options['stats'], sys.stderr)
+
+
+def print_stats (mode, fp):
+    if mode == 'json':
+        fp.write(json.dumps(metrics.snapshot()) + '\n')
+    else:
+        metrics.report(fp)
+    fp.flush()
+
+
+def execute (options, args, fp):
+    if 'build-index' in options:
+        source = options['build-index']
+        output = options.get('output') or \
+                LocalDict.index_path(get_config_store().get('local'))
+        count = build_dict_index(source, output)
+        print('%d entries written to %s' % (count, output), file = fp)
+        return 0
+    if 'usage' in options:
+        return print_usage(fp)
     engine = options.get('engine')
     if not engine:
         engine = 'all'
@@ -594,25 +3709,86 @@ def main(argv = None):
     tl = options.get('to') #translate to Language
     if not tl:
         tl = 'auto'
+    if 'batch' in options:
+        return run_batch(engine, sl, tl, options, fp)
+    if 'doc' in options:
+        return run_document(engine, sl, tl, args, options, fp)
+    if 'job' in options:
+        return run_job(engine, sl, tl, args, options, fp)
     if not args:
         msg = 'usage: translator.py {--engine=xx} {--from=xx} {--to=xx}'
-        print(msg + ' {-json} text')
-        print('engines:', list(ENGINES.keys()))
+        print(msg + ' {-json|--ndjson} {--raw} {--no-cache} {--refresh}'
+                ' {--deadline=sec} text', file = fp)
+        print('       translator.py --engine=xx --batch{=file} {--jobs=n}'
+                ' {--paragraph} {--tm{=threshold}}', file = fp)
+        print('       translator.py --engine=xx --doc{=file}'
+                ' {--tm{=threshold}}', file = fp)
+        print('       translator.py --engine=xx --job{=journal}'
+                ' --output=dir {--jobs=n} files|dirs|globs', file = fp)
+        print('       translator.py --build-index=ecdict.csv|xx.ifo'
+                ' {--output=file}', file = fp)
+        print('       translator.py --serve{=host:port}', file = fp)
+        print('       translator.py --client{=host:port} {options} text',
+                file = fp)
+        print('       translator.py --usage', file = fp)
+        print('options: {--stats{=json}}', file = fp)
+        print('engines:', list(ENGINES.keys()) + ['all', 'fastest', 'auto'],
+                file = fp)
         return 0
     text = ' '.join(args)
+    if engine == 'fastest':
+        config = get_config_store().get('fastest')
+        rank = options.get('rank') or config.get('rank')
+        names = rank and [ n.strip() for n in rank.split(',') ] or default_engines()
+        names = [ n for n in names if n in ENGINES ]
+        hedge = 'hedge' in options or config.get('hedge', 'no') == 'yes'
+        deadline = float(options.get('deadline') or 10)
+        delay = float(config.get('hedge_delay', 0.5))
+        outcome = race(names, sl, tl, text, options, deadline, hedge, delay)
+        return print_single(outcome, text, options, fp)
+    if engine == 'auto':
+        config = get_config_store().get('auto')
+        rank = options.get('rank') or config.get('engines')
+        names = rank and [ n.strip() for n in rank.split(',') ] or default_engines()
+        names = [ n for n in names if n in ENGINES ]
+        outcome = route(names, sl, tl, text, options, config)
+        return print_single(outcome, text, options, fp)
     if engine == 'all':
         #print(">"+text+"\n")
-        for engines in ENGINES.values():
-            thread = TransThread(sl, tl, text, engines, options)
-            thread.start()
+        names = default_engines()
+        outcomes = {}
+        deadline = float(options.get('deadline') or 10)
+        # --ndjson 按完成的先后输出，每个引擎一条记录
+        if 'ndjson' in options:
+            writer = RecordWriter(fp)
+            report = lambda outcome: writer.write(outcome.as_dict())
+            dispatch(list(names), sl, tl, text, options, deadline, report)
+            return 0
+        # 按注册顺序输出，前面的引擎有结论后立即打印
+        def report (outcome):
+            outcomes[outcome.engine] = outcome
+            while names and names[0] in outcomes:
+                print_outcome(outcomes[names.pop(0)], text.strip(),
+                        options, fp)
+        dispatch(list(names), sl, tl, text, options, deadline, report)
         return 0
-    cls = ENGINES.get(engine)
-    if not cls:
-        print('bad engine name: ' + engine)
+    if engine not in ENGINES:
+        print('bad engine name: ' + engine, file = fp)
+        return -1
+    if 'ndjson' in options:
+        outcome = run_engine(engine, sl, tl, text, options)
+        RecordWriter(fp).write(outcome.as_dict())
+        return outcome.status == 'ok' and 0 or -1
+    translator = load_engine(engine)
+    if translator is None:
+        return -1
+    try:
+        res = translator.lookup(sl, tl, text, 'no-cache' not in options,
+                'refresh' in options, 'raw' in options)
+    except TranslatorError as e:
+        sys.stderr.write('error: %s\n' % e)
         return -1
-    translator = cls()
-    res = translator.translate(sl, tl, text)
-    print_res(res,text,options)
+    print_res(res, text, options, fp)
     return 0
 
 